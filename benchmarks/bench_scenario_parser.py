@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Сравнение скорости разбора файлов сценариев *.sc.
+
+Генерирует синтетические сценарии размером в несколько мегабайт с большими
+разделами html:: и javascriptStudent:: и замеряет прежний построчный парсер
+и текущий scenarios.parse_scenario.
+
+Запуск:
+    python benchmarks/bench_scenario_parser.py [--sizes 1,2,4] [--repeat 3]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'multiengine'))
+
+from scenarios import SC_KEYS, parse_scenario  # noqa: E402
+
+
+def legacy_parse_scenario(scenario_path):
+    """
+    Парсер в том виде, в каком он был в MultiEngineXBlock.load_scenarios.
+    """
+    _scenario_content = {}
+    with open(scenario_path) as scf:
+        for line in scf:
+            if any(ext in line for ext in SC_KEYS):
+                _current_key = line.strip().strip(':')
+            else:
+                if _current_key in _scenario_content:
+                    _scenario_content[_current_key] += line.decode('utf-8')
+                else:
+                    _scenario_content[_current_key] = line.strip().decode('utf-8')
+    return _scenario_content
+
+
+def make_scenario(path, megabytes):
+    """
+    Сценарий, в котором html:: и javascriptStudent:: занимают по половине объема.
+    """
+    html_line = u'<div class="item" data-id="идентификатор">Перетащите элемент</div>\n'.encode('utf-8')
+    js_line = b'    element.addEventListener("click", function(e) { mengine.genID(); });\n'
+    half = megabytes * 1024 * 1024 // 2
+    with open(path, 'wb') as scf:
+        scf.write(b'name::\nBenchmark\ndescription::\nSynthetic scenario\n')
+        scf.write(b'html::\n' + html_line * (half // len(html_line)))
+        scf.write(b'javascriptStudent::\n' + js_line * (half // len(js_line)))
+        scf.write(b'javascriptStudio::\n\ncss::\n.item { color: red; }\ncssStudent::\n.item { color: red; }\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='1,2,4', help=u'размеры файлов в мегабайтах')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='multiengine-bench-')
+    try:
+        print('%8s %12s %12s %8s' % ('size, MB', 'legacy, s', 'current, s', 'speedup'))
+        for megabytes in [int(size) for size in args.sizes.split(',')]:
+            path = os.path.join(workdir, 'bench_%d.sc' % megabytes)
+            make_scenario(path, megabytes)
+
+            legacy = legacy_parse_scenario(path)
+            current = parse_scenario(path)
+            if set(legacy) != set(current) or \
+                    any(legacy[key].strip() != current[key].strip() for key in legacy):
+                raise SystemExit('Parsers disagree on %s' % path)
+
+            legacy_time = min(timeit.repeat(lambda: legacy_parse_scenario(path), number=1, repeat=args.repeat))
+            current_time = min(timeit.repeat(lambda: parse_scenario(path), number=1, repeat=args.repeat))
+            print('%8d %12.4f %12.4f %7.1fx' % (megabytes, legacy_time, current_time, legacy_time / current_time))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+"""Проверка ответов MultiEngineXBlock.
+Правильный ответ компилируется один раз в неизменяемый объект AnswerKey,
+который затем проверяет ответы студентов.
+Для массовой проверки (перепроверка, аналитика) есть grade_many,
+которая при наличии NumPy проверяет ответы матричными операциями."""
+
+import collections
+import hashlib
+import itertools
+import json
+import threading
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+KEYWORDS = ('or', 'and', 'not', 'or-and')
+
+ANSWER_KEY_CACHE_SIZE = 128
+
+GRADE_MANY_CHUNK_SIZE = 2048
+
+
+def _join(values):
+    """
+    ''.join(values) или None, если значения нельзя склеить.
+    """
+    try:
+        return ''.join(values)
+    except TypeError:
+        return None
+
+
+def _equal_joined(values, values_joined, expected_joined, expected_str):
+    """
+    Сравнение последовательностей склейкой строк,
+    а если склеить нельзя, то строковым представлением.
+    """
+    if values_joined is not None and expected_joined is not None:
+        return values_joined == expected_joined
+    return str(values) == expected_str
+
+
+def _item_variants(variants):
+    """
+    Индекс {значение: (номера вариантов, в которые оно входит)}.
+    """
+    index = {}
+    for i, variant in enumerate(variants):
+        for item in variant:
+            index.setdefault(item, []).append(i)
+    return dict((item, tuple(numbers)) for item, numbers in index.items())
+
+
+def _count_matches(student_area, item_variants):
+    """
+    Количество значений ответа, попавших в каждый вариант {номер: количество}.
+    Стоимость линейна по размеру ответа.
+    """
+    matches = {}
+    for answer in student_area:
+        for i in item_variants.get(answer, ()):
+            matches[i] = matches.get(i, 0) + 1
+    return matches
+
+
+class AnswerKey(object):
+    """
+    Скомпилированный правильный ответ.
+    Множества значений по областям, варианты "or" / "or-and" и их
+    максимальные длины вычисляются при компиляции, а не при проверке.
+    """
+
+    __slots__ = ('sequence', '_areas', '_static_values')
+
+    def __init__(self, correct_answer, sequence=False):
+        self.sequence = sequence is True
+        if self.sequence:
+            self._areas = tuple(self._compile_sequenced(correct_answer))
+            self._static_values = frozenset()
+        else:
+            self._areas = tuple(self._compile_not_sequenced(correct_answer))
+            static_values = set()
+            for _key, entries in self._areas:
+                for entry in entries:
+                    if entry[0] == 'item':
+                        static_values.add(entry[1])
+                    elif entry[0] == 'or-and':
+                        static_values.update(entry[4])
+            self._static_values = frozenset(static_values)
+
+    def __setattr__(self, name, value):
+        if hasattr(self, '_static_values'):
+            raise AttributeError("AnswerKey is immutable")
+        super(AnswerKey, self).__setattr__(name, value)
+
+    @staticmethod
+    def _compile_not_sequenced(correct_answer):
+        for key in correct_answer:
+            entries = []
+            for value in correct_answer[key]:
+                if value == 'or':
+                    variants = tuple(frozenset(variant) for variant in correct_answer[key][value])
+                    prefix_unions = []
+                    union = frozenset()
+                    for variant in variants:
+                        union = union | variant
+                        prefix_unions.append(union)
+                    # Пустой вариант всегда совпадает с ответом
+                    first_empty = next((i for i, variant in enumerate(variants) if not variant), None)
+                    entries.append(('or', variants, _item_variants(variants), first_empty,
+                                    tuple(prefix_unions), union))
+                elif value == 'or-and':
+                    raw_variants = correct_answer[key][value]
+                    variants = tuple(frozenset(variant) for variant in raw_variants)
+                    # Повторяющийся вариант засчитывается только один раз,
+                    # совпадение с его копией считается ошибкой.
+                    duplicates = tuple(
+                        any(raw_variants[j] == raw_variants[i] for j in range(i))
+                        for i in range(len(raw_variants))
+                    )
+                    # Область засчитывается как количество вариантов,
+                    # если среди них есть хотя бы один непустой.
+                    checked = len(variants) if any(variants) else 0
+                    union = frozenset().union(*variants)
+                    entries.append(('or-and', _item_variants(variants), duplicates, checked, union))
+                elif value in KEYWORDS:
+                    continue
+                else:
+                    entries.append(('item', value))
+            yield key, tuple(entries)
+
+    @staticmethod
+    def _compile_sequenced(correct_answer):
+        for key in correct_answer:
+            values = correct_answer[key]
+            if not isinstance(values, dict):
+                items = tuple(values) if isinstance(values, list) else values
+                try:
+                    members = frozenset(values) if isinstance(values, list) else items
+                except TypeError:
+                    members = items
+                yield key, ('list', (
+                    members, items, len(values), _join(values), str(values)
+                ))
+            else:
+                groups = []
+                for keyword in KEYWORDS:
+                    if keyword in values:
+                        variants = tuple((_join(variant), str(variant)) for variant in values[keyword])
+                        max_length = max([len(variant) for variant in values[keyword]] or [0])
+                        groups.append((variants, max_length))
+                yield key, ('dict', tuple(groups))
+
+    def check(self, student_answer):
+        """
+        Проверка ответа студента {"область": [значения]}.
+        Возвращает словарь с долей правильных значений (result),
+        правильными и неправильными значениями.
+        """
+        if self.sequence:
+            return self._check_sequenced(student_answer)
+        return self._check_not_sequenced(student_answer)
+
+    def _check_not_sequenced(self, student_answer, checked=0, correct=0):
+        """
+        Вычисляет долю выполненных заданий без учета
+        последовательности элементов в области.
+        Время проверки линейно по размеру ответа: совпадения с вариантами
+        "or" / "or-and" считаются по индексу значение -> варианты.
+        """
+        fail = False
+
+        right_answers = []
+        wrong_answers = []
+
+        # Объединения вариантов "or", засчитанных как правильные значения
+        or_unions = []
+
+        for key, entries in self._areas:
+            student_area = None
+            for entry in entries:
+                if student_area is None:
+                    student_area = set(student_answer[key])
+                kind = entry[0]
+                if kind == 'item':
+                    value = entry[1]
+                    if value in student_area:
+                        right_answers.append(value)
+                        correct += 1
+                    else:
+                        wrong_answers.append(value)
+                    checked += 1
+                elif kind == 'or':
+                    _kind, variants, item_variants, matched, prefix_unions, union = entry
+                    for i, count in _count_matches(student_area, item_variants).items():
+                        if count == len(variants[i]) and (matched is None or i < matched):
+                            matched = i
+                    area_length = len(student_answer[key])
+                    if matched is None:
+                        or_unions.append(union)
+                    else:
+                        or_unions.append(prefix_unions[matched])
+                        correct += area_length
+                    checked += area_length
+                else:
+                    _kind, item_variants, duplicates, variants_checked, _union = entry
+                    for i, count in _count_matches(student_area, item_variants).items():
+                        if duplicates[i] or count > 1:
+                            fail = True
+                        if not duplicates[i]:
+                            correct += 1
+                    checked += variants_checked
+
+        if not fail:
+            for key in student_answer:
+                for value in student_answer[key]:
+                    if value not in self._static_values and \
+                            not any(value in union for union in or_unions):
+                        fail = True
+                        break
+        if fail:
+            correct = 0
+
+        checks = {"result": correct / float(checked),
+                  "right_answers": right_answers,
+                  "wrong_answers": wrong_answers,
+                  "checked": checked
+                  }
+        return checks
+
+    def _check_sequenced(self, student_answer, checked=0, correct=0):
+        """
+        Вычисляет долю выполненных заданий с учетом
+        последовательности элементов в области.
+        """
+        right_answers = []
+        wrong_answers = []
+
+        answer_condition = False
+
+        for key, (kind, data) in self._areas:
+            if kind == 'list':
+                members, items, length, joined, as_str = data
+                student_area = student_answer[key]
+                try:
+                    student_answer_true = [item for item in student_area if item in members]
+                except TypeError:
+                    # Нехешируемые значения ответа ищутся в исходном списке
+                    student_answer_true = [item for item in student_area if item in items]
+                answer_condition = _equal_joined(
+                    student_answer_true,
+                    _join(student_answer_true) if joined is not None else None,
+                    joined, as_str)
+
+                if answer_condition:
+                    right_answers += student_answer_true
+                    correct += length
+                else:
+                    wrong_answers += student_answer_true
+                checked += length
+
+            else:
+                for variants, max_length in data:
+                    student_values = student_answer[key]
+                    student_joined = _join(student_values)
+                    for variant_joined, variant_str in variants:
+                        answer_condition = _equal_joined(
+                            student_values, student_joined, variant_joined, variant_str)
+                        if answer_condition:
+                            break
+
+                    checked += max_length
+
+                    if answer_condition:
+                        right_answers += student_values
+                        correct += len(student_values)
+                    else:
+                        wrong_answers += student_values
+
+        checks = {"result": correct / float(checked),
+                  "right_answers": right_answers,
+                  "wrong_answers": wrong_answers,
+                  }
+        return checks
+
+
+def weighted_points(result, weight):
+    """
+    Баллы студента по доле правильных значений и весу задания.
+    """
+    return int(round(result * weight))
+
+
+_answer_keys = collections.OrderedDict()
+_answer_keys_lock = threading.Lock()
+
+
+def compile_answer_key(correct_answer, sequence=False):
+    """
+    AnswerKey для правильного ответа в формате json-строки
+    {"answer": {...}, "settings": {...}}.
+    Скомпилированные ответы хранятся в LRU-кеше по хешу ответа и sequence.
+    """
+    if isinstance(correct_answer, unicode):
+        digest = hashlib.sha1(correct_answer.encode('utf-8')).hexdigest()
+    else:
+        digest = hashlib.sha1(correct_answer).hexdigest()
+    cache_key = (digest, sequence is True)
+
+    with _answer_keys_lock:
+        answer_key = _answer_keys.pop(cache_key, None)
+        if answer_key is not None:
+            _answer_keys[cache_key] = answer_key
+            return answer_key
+
+    answer_key = AnswerKey(json.loads(correct_answer)["answer"], sequence)
+
+    with _answer_keys_lock:
+        _answer_keys[cache_key] = answer_key
+        while len(_answer_keys) > ANSWER_KEY_CACHE_SIZE:
+            _answer_keys.popitem(last=False)
+    return answer_key
+
+
+def _check_result(answer_key, student_answer):
+    """
+    Доля правильных значений одного ответа или None при ошибке проверки.
+    """
+    try:
+        return answer_key.check(student_answer)["result"]
+    except (KeyError, IndexError, TypeError, AttributeError, ZeroDivisionError):
+        return None
+
+
+def grade_many(answers, answer_key, chunk_size=GRADE_MANY_CHUNK_SIZE):
+    """
+    Проверка списка ответов {"область": [значения]} одним правильным ответом.
+    Возвращает список долей правильных значений, совпадающих с
+    answer_key.check(answer)["result"], или None для ответов, проверка
+    которых завершилась бы ошибкой.
+    Ответы без учета последовательности проверяются матричными операциями
+    NumPy (значения кодируются целыми числами один раз на правильный ответ);
+    без NumPy и для ответов с последовательностью — по одному.
+    """
+    if numpy is None or answer_key.sequence:
+        return [_check_result(answer_key, answer) for answer in answers]
+
+    plan = _BatchPlan(answer_key)
+    results = []
+    for start in range(0, len(answers), chunk_size):
+        results.extend(plan.grade(answers[start:start + chunk_size]))
+    return results
+
+
+class _BatchPlan(object):
+    """
+    Правильный ответ без учета последовательности в виде матриц:
+    значения закодированы номерами столбцов, варианты "or" / "or-and" —
+    строками индикаторных матриц. Последний столбец — значения,
+    которых нет в правильном ответе.
+    """
+
+    def __init__(self, answer_key):
+        codes = {}
+
+        def code(item):
+            return codes.setdefault(item, len(codes))
+
+        static_codes = [code(item) for item in answer_key._static_values]
+        raw_areas = []
+        for key, entries in answer_key._areas:
+            if not entries:
+                continue
+            raw_entries = []
+            for entry in entries:
+                if entry[0] == 'item':
+                    raw_entries.append(('item', code(entry[1])))
+                elif entry[0] == 'or':
+                    _kind, variants, _item_variants, _first_empty, prefix_unions, _union = entry
+                    raw_entries.append((
+                        'or',
+                        [[code(item) for item in variant] for variant in variants],
+                        [[code(item) for item in union] for union in prefix_unions],
+                    ))
+                else:
+                    _kind, item_variants, duplicates, checked, _union = entry
+                    raw_entries.append((
+                        'or-and',
+                        [(code(item), numbers) for item, numbers in item_variants.items()],
+                        duplicates,
+                        checked,
+                    ))
+            raw_areas.append((key, raw_entries))
+
+        self.unknown = len(codes)
+        self.codes = codes
+        self.width = len(codes) + 1
+        self.static_mask = self._mask([static_codes])[0]
+
+        self.area_numbers = dict((key, number) for number, (key, _entries) in enumerate(raw_areas))
+        self.required_keys = frozenset(self.area_numbers)
+        self.areas = []
+        for key, raw_entries in raw_areas:
+            area_entries = []
+            for entry in raw_entries:
+                if entry[0] == 'item':
+                    area_entries.append(entry)
+                elif entry[0] == 'or':
+                    variants = self._mask(entry[1]).astype(numpy.float32)
+                    area_entries.append(('or', variants, variants.sum(axis=1), self._mask(entry[2])))
+                else:
+                    _kind, item_variants, duplicates, checked = entry
+                    variants = numpy.zeros((len(duplicates), self.width), dtype=numpy.float32)
+                    for item_code, numbers in item_variants:
+                        variants[list(numbers), item_code] = 1
+                    area_entries.append(('or-and', variants, numpy.array(duplicates, dtype=bool), checked))
+            self.areas.append((key, area_entries))
+
+    def _mask(self, rows):
+        mask = numpy.zeros((len(rows), self.width), dtype=bool)
+        for i, row_codes in enumerate(rows):
+            mask[i, row_codes] = True
+        return mask
+
+    def _flatten(self, answers):
+        """
+        Все списки значений ответов одним проходом: номер строки и номер
+        области (-1 для ключей не из правильного ответа) каждого списка,
+        длины списков и коды всех значений подряд.
+        """
+        required = self.required_keys
+        keys, values, sizes = [], [], []
+        for answer in answers:
+            if not required.issubset(answer):
+                raise KeyError(answer)
+            keys.extend(answer)
+            values.extend(answer.itervalues())
+            sizes.append(len(answer))
+
+        count = len(values)
+        rows = numpy.repeat(numpy.arange(len(answers), dtype=numpy.intp), sizes)
+        areas = numpy.fromiter(
+            itertools.imap(self.area_numbers.get, keys, itertools.repeat(-1)),
+            dtype=numpy.intp, count=count,
+        )
+        lengths = numpy.fromiter(itertools.imap(len, values), dtype=numpy.intp, count=count)
+        codes = numpy.fromiter(
+            itertools.imap(self.codes.get, itertools.chain.from_iterable(values), itertools.repeat(self.unknown)),
+            dtype=numpy.intp, count=int(lengths.sum()),
+        )
+        return rows, areas, lengths, codes
+
+    def _encode(self, answers):
+        """
+        Индикаторные матрицы значений ответов: всех и по областям.
+        """
+        count = len(answers)
+        errors = numpy.zeros(count, dtype=bool)
+        try:
+            rows, areas, lengths, codes = self._flatten(answers)
+        except (KeyError, IndexError, TypeError, AttributeError):
+            # Ответы, на которых проверка завершилась бы ошибкой, ищутся
+            # по одному и заменяются пустыми.
+            empty = dict.fromkeys(self.area_numbers, ())
+            answers = list(answers)
+            for row, answer in enumerate(answers):
+                try:
+                    self._flatten([answer])
+                except (KeyError, IndexError, TypeError, AttributeError):
+                    errors[row] = True
+                    answers[row] = empty
+            rows, areas, lengths, codes = self._flatten(answers)
+
+        value_rows = numpy.repeat(rows, lengths)
+        value_areas = numpy.repeat(areas, lengths)
+        present = numpy.zeros((count, self.width), dtype=bool)
+        present[value_rows, codes] = True
+        area_masks = {}
+        area_lengths = {}
+        for key, number in self.area_numbers.items():
+            selected = value_areas == number
+            area_masks[key] = numpy.zeros((count, self.width), dtype=bool)
+            area_masks[key][value_rows[selected], codes[selected]] = True
+            segments = areas == number
+            area_lengths[key] = numpy.bincount(
+                rows[segments], weights=lengths[segments], minlength=count).astype(numpy.int64)
+        return errors, present, area_masks, area_lengths
+
+    def grade(self, answers):
+        count = len(answers)
+        errors, present, area_masks, area_lengths = self._encode(answers)
+
+        correct = numpy.zeros(count, dtype=numpy.int64)
+        checked = numpy.zeros(count, dtype=numpy.int64)
+        fail = numpy.zeros(count, dtype=bool)
+        allowed = numpy.tile(self.static_mask, (count, 1))
+
+        for key, entries in self.areas:
+            mask = area_masks[key]
+            # Счетчики совпадений считаются умножением матриц в float32 (BLAS):
+            # значения — небольшие целые числа и вычисляются точно.
+            counts_mask = mask.astype(numpy.float32)
+            for entry in entries:
+                if entry[0] == 'item':
+                    correct += mask[:, entry[1]]
+                    checked += 1
+                elif entry[0] == 'or':
+                    _kind, variants, sizes, prefix_unions = entry
+                    lengths = area_lengths[key]
+                    checked += lengths
+                    if not len(variants):
+                        continue
+                    covered = counts_mask.dot(variants.T) == sizes
+                    matched = covered.any(axis=1)
+                    first = numpy.where(matched, covered.argmax(axis=1), len(variants) - 1)
+                    allowed |= prefix_unions[first]
+                    correct += lengths * matched
+                else:
+                    _kind, variants, duplicates, variants_checked = entry
+                    checked += variants_checked
+                    if not len(variants):
+                        continue
+                    matches = counts_mask.dot(variants.T)
+                    matched = matches > 0
+                    fail |= (matched & duplicates).any(axis=1) | (matches > 1).any(axis=1)
+                    correct += (matched & ~duplicates).sum(axis=1)
+
+        fail |= (present & ~allowed).any(axis=1)
+        correct[fail] = 0
+
+        return [
+            None if errors[row] or not checked[row] else int(correct[row]) / float(checked[row])
+            for row in range(count)
+        ]
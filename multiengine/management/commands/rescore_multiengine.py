@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""Перепроверка сохраненных ответов MultiEngineXBlock.
+
+Пример:
+    ./manage.py lms rescore_multiengine --course course-v1:UrFU+ME+2016 \
+        --processes 8 --checkpoint /tmp/rescore.json
+
+Для работы команды пакет multiengine должен быть в INSTALLED_APPS.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from multiengine.rescore import BATCH_SIZE, find_blocks, rescore_blocks
+
+
+class Command(BaseCommand):
+    help = u"Перепроверяет ответы студентов после изменения правильного ответа или веса и публикует новые оценки."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--course', dest='course_id', help=u"id курса: перепроверить все блоки курса")
+        parser.add_argument('--block', dest='usage_id', help=u"usage id одного блока")
+        parser.add_argument('--processes', type=int, default=None,
+                            help=u"количество процессов (по умолчанию по числу CPU)")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--checkpoint', default=None,
+                            help=u"файл для сохранения позиции; повторный запуск продолжит с нее")
+
+    def handle(self, *args, **options):
+        if not options['course_id'] and not options['usage_id']:
+            raise CommandError(u"Укажите --course или --block")
+
+        blocks = find_blocks(options['course_id'], options['usage_id'])
+        totals = rescore_blocks(
+            blocks,
+            processes=options['processes'],
+            batch_size=options['batch_size'],
+            checkpoint_path=options['checkpoint'],
+        )
+        self.stdout.write(
+            u"Blocks: %d, rescored: %d, changed: %d, skipped: %d, errors: %d" % (
+                len(blocks), totals['rescored'], totals['changed'], totals['skipped'], totals['errors']))
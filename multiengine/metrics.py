@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Метрики MultiEngineXBlock.
+Счетчики и гистограммы времени выполнения копятся в памяти процесса
+и отдаются в текстовом формате Prometheus (см. обработчик metrics блока).
+Если задан STATSD_HOST, каждое измерение дополнительно отправляется
+по UDP в формате StatsD, что позволяет собрать данные всех процессов."""
+
+import logging
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from settings import METRICS_BUCKETS, STATSD_HOST, STATSD_PORT, STATSD_PREFIX
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'multiengine_'
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_collectors = []
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    """
+    Увеличение счетчика name_total.
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _statsd('%s:%d|c' % (_statsd_name(name, labels), value))
+
+
+def observe(name, seconds, **labels):
+    """
+    Измерение времени для гистограммы name_seconds.
+    """
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(METRICS_BUCKETS), 0.0, 0]
+        buckets = histogram[0]
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                buckets[i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+    _statsd('%s:%.3f|ms' % (_statsd_name(name, labels), seconds * 1000))
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Время выполнения блока with в гистограмме name_seconds;
+    исключения дополнительно считаются в name_errors_total.
+    """
+    started = time.time()
+    try:
+        yield
+    except Exception:
+        increment(name + '_errors', **labels)
+        raise
+    finally:
+        observe(name, time.time() - started, **labels)
+
+
+def timed(name, **labels):
+    """
+    Декоратор: время выполнения функции (см. timer).
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_collector(collector):
+    """
+    Функция, возвращающая {имя счетчика: значение}; вызывается при выдаче
+    метрик (для счетчиков, которые ведутся в другом месте).
+    """
+    _collectors.append(collector)
+
+
+def _labels_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (label, unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for label, value in pairs
+    )
+
+
+def render_prometheus():
+    """
+    Все метрики процесса в текстовом формате Prometheus.
+    """
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, (list(value[0]), value[1], value[2])) for key, value in _histograms.items())
+    for collector in _collectors:
+        try:
+            counters += sorted((_key(name, {}), value) for name, value in collector().items())
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("[MultiEngineXBlock]: " + "Metrics collector failed")
+
+    lines = []
+    typed = set()
+    for (name, labels), value in counters:
+        metric = PREFIX + name + '_total'
+        if metric not in typed:
+            typed.add(metric)
+            lines.append('# TYPE %s counter' % metric)
+        lines.append('%s%s %s' % (metric, _labels_text(labels), value))
+
+    for (name, labels), (buckets, total, count) in histograms:
+        metric = PREFIX + name + '_seconds'
+        if metric not in typed:
+            typed.add(metric)
+            lines.append('# TYPE %s histogram' % metric)
+        for bound, bucket in zip(METRICS_BUCKETS, buckets):
+            lines.append('%s_bucket%s %d' % (metric, _labels_text(labels, [('le', repr(float(bound)))]), bucket))
+        lines.append('%s_bucket%s %d' % (metric, _labels_text(labels, [('le', '+Inf')]), count))
+        lines.append('%s_sum%s %r' % (metric, _labels_text(labels), total))
+        lines.append('%s_count%s %d' % (metric, _labels_text(labels), count))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """
+    Обнуление накопленных метрик.
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+_STATSD_UNSAFE = re.compile(r'[^A-Za-z0-9_-]')
+_statsd_socket = None
+_statsd_address = None
+
+
+def _statsd_name(name, labels):
+    """
+    Имя метрики StatsD: значения меток добавляются к имени через точку.
+    """
+    return '.'.join([name] + [_STATSD_UNSAFE.sub('_', unicode(value)) for _label, value in sorted(labels.items())])
+
+
+def _statsd(line):
+    """
+    Отправка измерения в StatsD; ошибки отправки игнорируются.
+    """
+    global _statsd_socket, _statsd_address  # pylint: disable=global-statement
+    if not STATSD_HOST:
+        return
+    try:
+        if _statsd_socket is None:
+            _statsd_address = (socket.gethostbyname(STATSD_HOST), STATSD_PORT)
+            _statsd_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _statsd_socket.setblocking(False)
+        _statsd_socket.sendto((STATSD_PREFIX + '.' + line).encode('utf-8'), _statsd_address)
+    except (socket.error, socket.gaierror):
+        pass
@@ -6,24 +6,22 @@ import datetime
 import pkg_resources
 import pytz
 import json
-import os
 from path import path
-import git
-import shutil
 import logging
-import copy
+import hashlib
+import time
 
 
 from django.template import Context, Template
-from django.utils.encoding import smart_text
+from django.utils.encoding import smart_str, smart_text
 from django.core.exceptions import PermissionDenied
 
 from student.models import user_by_anonymous_id
-from submissions import api as submissions_api
 from submissions.models import StudentItem as SubmissionsStudent
 
 import xblock
 from xblock.core import XBlock
+from xblock.exceptions import JsonHandlerError
 from xblock.fields import Scope, Integer, String, JSONField, Boolean
 from xblock.fragment import Fragment
 
@@ -31,7 +29,16 @@ from xmodule.util.duedate import get_extended_due_date
 
 from webob.response import Response
 
-from settings import GIT_REPO_URL, GIT_BRANCH
+from settings import (
+    LEGACY_SCENARIOS_ROOT, RELOAD_RESOURCES, SCENARIOS_STORE, SCENARIO_CACHE_MAX_AGE, STUDENT_STATE_MAX_SIZE
+)
+from grading import compile_answer_key, weighted_points
+from student_state import StudentStateTooLarge, encode_state, decode_state
+from scenarios import SC_KEYS, get_registry, get_index, read_head_sha, gzip_payload
+import repository
+import metrics
+
+SCENARIO_ASSETS_URI = 'public/scenario-assets/'
 
 logger = logging.getLogger(__name__)
 
@@ -100,6 +107,13 @@ class MultiEngineXBlock(XBlock):
         default=None,
     )
 
+    scenario_commit = String(
+        display_name=u"Версия сценария",
+        help=u"Коммит репозитория сценариев, за которым закреплен блок.",
+        scope=Scope.settings,
+        default=None,
+    )
+
     max_attempts = Integer(
         display_name=u"Максимальное количество попыток",
         help=u"",
@@ -107,6 +121,13 @@ class MultiEngineXBlock(XBlock):
         scope=Scope.settings
     )
 
+    max_student_state_size = Integer(
+        display_name=u"Максимальный размер сохраненного состояния",
+        help=u"Размер состояния студента в байтах (0 — без ограничения).",
+        default=STUDENT_STATE_MAX_SIZE,
+        scope=Scope.settings
+    )
+
     # user_state
     points = Integer(
         display_name=u"Количество баллов студента",
@@ -131,6 +152,24 @@ class MultiEngineXBlock(XBlock):
         scope=Scope.user_state
     )
 
+    student_state_version = Integer(
+        display_name=u"Версия сохраненного состояния",
+        default=0,
+        scope=Scope.user_state
+    )
+
+    student_state_sequence = Integer(
+        display_name=u"Номер последнего сохранения состояния",
+        default=0,
+        scope=Scope.user_state
+    )
+
+    published_grade = JSONField(
+        display_name=u"Последняя опубликованная оценка",
+        default=None,
+        scope=Scope.user_state
+    )
+
     student_view_template = String(
         display_name=u"Шаблон сценария",
         default='',
@@ -146,103 +185,169 @@ class MultiEngineXBlock(XBlock):
 
 
     MULTIENGINE_ROOT = path(__file__).abspath().dirname().dirname() + '/multiengine'
-    SCENARIOS_ROOT = MULTIENGINE_ROOT + '/public/scenarios/'
+    SCENARIOS_STORE = SCENARIOS_STORE
+    # Активная версия сценариев в хранилище
+    SCENARIOS_ROOT = repository.current_path(SCENARIOS_STORE) + '/'
 
     def is_repo(self):
-            repo_exists = False
-            if os.path.exists(self.SCENARIOS_ROOT) and os.path.isdir(self.SCENARIOS_ROOT):
-                for file_item in os.listdir(self.SCENARIOS_ROOT):
-                    if file_item and file_item == '.git':
-                        repo_exists = True
-                    elif not file_item:
-                        pass
-                    else:
-                        pass
-            return repo_exists
+        return repository.is_repo(repository.repo_path(self.SCENARIOS_STORE))
 
     @staticmethod
-    def clean_repo_path(scenarios_root=SCENARIOS_ROOT):
+    def clean_repo_path(scenarios_root=repository.repo_path(SCENARIOS_STORE)):
         """
         Удаление локального репозитория сценариев
         """
-        shutil.rmtree(scenarios_root, ignore_errors=True)
+        repository.clean_repo_path(scenarios_root)
     
     def update_local_repo(self):
         """
         Обновление локального репозитория сценариев
         """
-        latest = False
-        scenarios_repo = git.Repo(self.SCENARIOS_ROOT)
-        scenarios_repo_remote = git.Remote(
-            scenarios_repo,
-            'master')
-        info = scenarios_repo_remote.fetch()[0]
-        remote_commit = info.commit
-        if scenarios_repo.commit().hexsha == remote_commit.hexsha:
-            latest = True
-    
-        while remote_commit.hexsha != scenarios_repo.commit().hexsha:
-            remote_commit = remote_commit.parents[0]
-        return latest
+        return repository.update_local_repo(repository.repo_path(self.SCENARIOS_STORE))
 
     def clone_repo(self):
         """
         Клонирование репозитория со сценариями.
         Адрес репозитория хранится в переменной GIT_REPO_URL в settings.py.
         """
-        scenarios_repo = git.Repo.clone_from(
-            GIT_REPO_URL,
-            self.SCENARIOS_ROOT,
-            branch=GIT_BRANCH
-        )
-        scenarios_repo = git.Repo(self.SCENARIOS_ROOT)
-        latest = True
-        return scenarios_repo, latest
+        return repository.clone_repo(repository.repo_path(self.SCENARIOS_STORE))
 
     def load_scenarios(self, keys=None):
         """
         Загрузка сценариев из локального репозитория в список.
+        Разобранные сценарии кешируются в реестре процесса.
         """
-        scenarios = {}
-        _sc_keys = [
-            'name::',
-            'description::',
-            'html::',
-            'javascriptStudent::',
-            'javascriptStudio::',
-            'css::',
-            'cssStudent::',
-            ]
         if keys == "get":
-            return _sc_keys
+            return SC_KEYS
 
-        if os.path.exists(self.SCENARIOS_ROOT) and os.path.isdir(self.SCENARIOS_ROOT):
+        repository.prepare_store(self.SCENARIOS_STORE, LEGACY_SCENARIOS_ROOT)
+        with metrics.timer('load_scenarios'):
+            return get_registry(self.SCENARIOS_ROOT).scenarios()
 
-            def _scenario_parser(scenario_file):
-                _scenario_content = {}
-                with open(self.SCENARIOS_ROOT + scenario_file) as scf:
-                    for line in scf:
-                        if any(ext in line for ext in _sc_keys):
-                            _current_key = line.strip().strip(':')
-                        else:
-                            if _current_key in _scenario_content:
-                                _scenario_content[_current_key] += line.decode('utf-8')
-                            else:
-                                _scenario_content[_current_key] = line.strip().decode('utf-8')
-                return _scenario_content
+    def load_scenario(self, name, scenarios_root=None):
+        """
+        Загрузка одного сценария: из индекса репозитория, а если индекса нет
+        или сценария в нем нет, то разбором только файла этого сценария.
+        Возвращает None, если сценарий не найден.
+        """
+        repository.prepare_store(self.SCENARIOS_STORE, LEGACY_SCENARIOS_ROOT)
+        scenarios_root = scenarios_root or self.SCENARIOS_ROOT
+        with metrics.timer('load_scenario'):
+            index = get_index(scenarios_root)
+            if index is not None and name in index:
+                return index.get(name)
+            return get_registry(scenarios_root).scenario(name)
 
-            for scenario_file in os.listdir(self.SCENARIOS_ROOT):
-                if scenario_file.endswith(".sc"):
-                    scenarios[os.path.splitext(scenario_file)[0]] = _scenario_parser(scenario_file)
+    def scenarios_root(self):
+        """
+        Каталог сценариев блока: закрепленная версия или активная.
+        Пока закрепленная версия выгружается в фоне, отдается активная.
+        """
+        if self.scenario_commit:
+            try:
+                snapshot = repository.find_snapshot(self.SCENARIOS_STORE, self.scenario_commit, self.pin_owner())
+                if snapshot is not None:
+                    return snapshot + '/'
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("[MultiEngineXBlock]: " + "Pinned scenarios version is not available")
+        return self.SCENARIOS_ROOT
 
-        return scenarios
+    def scenario_version(self):
+        """
+        Версия сценария для неизменяемого URL send_scenario
+        или None, если блок не закреплен за коммитом.
+        """
+        if not (self.scenario_commit and self.scenario):
+            return None
+        return hashlib.sha1(smart_str(self.scenario_commit + ':' + self.scenario)).hexdigest()
+
+    def scenario_key(self):
+        """
+        Ключ сценария на клиенте: блоки с одним и тем же сценарием одной
+        версии загружают его один раз на страницу.
+        """
+        if not self.scenario:
+            return None
+        return self.scenario_version() or hashlib.sha1(
+            smart_str((read_head_sha(self.SCENARIOS_ROOT) or '') + ':' + self.scenario)
+        ).hexdigest()
+
+    def pin_owner(self):
+        """
+        Имя отметки блока в pins/ хранилища сценариев.
+        """
+        return hashlib.sha1(smart_str(unicode(self.scope_ids.usage_id))).hexdigest()
+
+    def pin_scenario(self):
+        """
+        Закрепление блока за текущим коммитом репозитория сценариев.
+        """
+        commit = read_head_sha(self.SCENARIOS_ROOT)
+        if commit is not None:
+            repository.find_snapshot(self.SCENARIOS_STORE, commit, self.pin_owner())
+        if self.scenario_commit != commit:
+            self.unpin_scenario()
+        self.scenario_commit = commit
+
+    def unpin_scenario(self):
+        """
+        Снятие закрепления блока: версия, за которой больше не закреплен
+        ни один блок, удаляется при следующей синхронизации.
+        """
+        if self.scenario_commit:
+            repository.unpin_snapshot(self.SCENARIOS_STORE, self.scenario_commit, self.pin_owner())
+        self.scenario_commit = None
+
+    @classmethod
+    def open_local_resource(cls, uri):
+        """
+        Файлы JS и CSS сценариев отдаются из хранилища сценариев.
+        """
+        if uri.startswith(SCENARIO_ASSETS_URI):
+            return repository.open_asset(cls.SCENARIOS_STORE, uri[len(SCENARIO_ASSETS_URI):])
+        return super(MultiEngineXBlock, cls).open_local_resource(uri)
+
+    def scenario_context(self, scenarios_root=None, inline=False):
+        """
+        Разделы сценария блока в том виде, в котором они уходят клиенту.
+        JS и CSS, вынесенные в файлы, передаются ссылками в "assets";
+        с inline=True они передаются текстом (если файлы не загрузились).
+        """
+        scenario = self.load_scenario(smart_text(self.scenario), scenarios_root or self.scenarios_root())
+        if scenario is not None:
+            context = {}
+            for key in SC_KEYS:
+                key = key.strip(':')
+                if key in scenario:
+                    context[key] = scenario[key].strip()
+            assets = scenario.get('assets')
+            if assets and not inline:
+                context['assets'] = {}
+                for section, name in assets.items():
+                    context.pop(section, None)
+                    context['assets'][section] = {
+                        'id': name.split('.')[0],
+                        'url': self.runtime.local_resource_url(self, SCENARIO_ASSETS_URI + name),
+                    }
+
+        else:
+            context = {
+                "name": '',
+                "html": 'Scenario not found',
+                "css": '',
+                "javascriptStudent": '',
+                "javascriptStudio": '',
+                "description": '',
+                "cssStudent": '',
+            }
+        return context
 
     def get_scenario_content(self, scenario):
         """
         Получение текста сценария.
         """
         try:
-            scenario_file = open(self.SCENARIOS_ROOT + scenario + '.cs', 'r')
+            scenario_file = open(self.scenarios_root() + scenario + '.cs', 'r')
 
             with scenario_file as jsfile:
                 scenario_content = jsfile.read()
@@ -258,8 +363,7 @@ class MultiEngineXBlock(XBlock):
         """
         Handy helper for getting resources from our kit.
         """
-        data = pkg_resources.resource_string(__name__, path)
-        return data.decode("utf8")
+        return load_resource(path)
 
     def load_resources(self, js_urls, css_urls, fragment):
         """
@@ -341,21 +445,12 @@ class MultiEngineXBlock(XBlock):
             "correct_answer": self.correct_answer,
             "answer": self.answer,
             "attempts": self.attempts,
-            "student_state_json": self.student_state_json,
+            "student_state_json": self.load_student_state(),
             "student_view_template": self.student_view_template,
             "scenario": self.scenario,
             "scenarios": scenarios,
         }
 
-        # Rescore student
-        score = submissions_api.get_score(self.get_student_item_dict())
-
-        # It's temporary! It's crutch, not magick.
-        self.runtime.publish(self, 'grade', {
-                'value': self.points,
-                'max_value': self.weight,
-        })
-
         if self.max_attempts != 0:
             context["max_attempts"] = self.max_attempts
 
@@ -380,6 +475,7 @@ class MultiEngineXBlock(XBlock):
         )
 
         js_urls = (
+            'static/js/mengine.js',
             'static/js/multiengine.js',
         )
 
@@ -389,7 +485,17 @@ class MultiEngineXBlock(XBlock):
 
         self.load_resources(js_urls, css_urls, fragment)
 
-        fragment.initialize_js('MultiEngineXBlock')
+        # Сценарий и сохраненное состояние передаются сразу во фрагменте,
+        # чтобы клиенту не нужно было запрашивать их отдельно.
+        # Среда выполнения вставляет json_args в тег <script> как есть, поэтому
+        # сценарий и состояние передаются JSON-текстом без символов < > &
+        fragment.initialize_js('MultiEngineXBlock', json_args={
+            "scenario_json": embed_json(self.scenario_context()),
+            "scenario_version": self.scenario_version(),
+            "scenario_key": self.scenario_key(),
+            "student_state_json": embed_json(self.load_student_state()),
+            "student_state_sequence": self.student_state_sequence,
+        })
         return fragment
 
     def studio_view(self, *args, **kwargs):
@@ -407,7 +513,9 @@ class MultiEngineXBlock(XBlock):
             "answer": self.answer,
             "sequence": self.sequence,
             "scenario": self.scenario,
+            "scenario_commit": self.scenario_commit,
             "max_attempts": self.max_attempts,
+            "max_student_state_size": self.max_student_state_size,
             "student_view_template": self.student_view_template,
 
             "scenarios": scenarios,
@@ -426,6 +534,7 @@ class MultiEngineXBlock(XBlock):
         )
 
         js_urls = (
+            "static/js/mengine.js",
             "static/js/multiengine_edit.js",
         )
 
@@ -434,7 +543,10 @@ class MultiEngineXBlock(XBlock):
         )
 
         self.load_resources(js_urls, css_urls, fragment)
-        fragment.initialize_js('MultiEngineXBlockEdit')
+        fragment.initialize_js('MultiEngineXBlockEdit', json_args={
+            "scenario_version": self.scenario_version(),
+            "scenario_key": self.scenario_key(),
+        })
 
         try:
             correct_answer = json.loads(self.correct_answer)
@@ -485,27 +597,55 @@ class MultiEngineXBlock(XBlock):
     def save_student_state(self, data, suffix=''):
         """
         Handler for saving student state (save student answer without checking).
+        Клиент передает {"state": ..., "sequence": n}; запись с номером
+        не больше уже сохраненного устарела и отбрасывается без записи в БД.
         :param request:
         :param suffix:
         :return:
         """
-        self.student_state_json = data
-        return {'result': 'success'}
+        sequence = None
+        if isinstance(data, dict) and 'sequence' in data:
+            try:
+                sequence = int(data['sequence'])
+            except (TypeError, ValueError):
+                raise JsonHandlerError(400, "Bad state sequence")
+            if sequence <= self.student_state_sequence:
+                return {'result': 'stale', 'sequence': self.student_state_sequence}
+            data = data.get('state')
+
+        try:
+            self.student_state_json = encode_state(data, self.max_student_state_size)
+        except StudentStateTooLarge as exc:
+            raise JsonHandlerError(413, unicode(exc))
+        self.student_state_version += 1
+        if sequence is not None:
+            self.student_state_sequence = sequence
+        return {'result': 'success', 'sequence': self.student_state_sequence}
+
+    def load_student_state(self):
+        """
+        Сохраненное состояние студента в исходном виде (JSON-строка).
+        """
+        return decode_state(self.student_state_json)
 
 
     @XBlock.handler
-    def get_student_state(self, data, suffix=''):
+    def get_student_state(self, request, suffix=''):
         """
         Return student state as json.
+        Supports conditional GET. The handler URL is the same for every user,
+        so the ETag is derived from the state content as well as its version.
         :param request:
         :param suffix:
         :return:
         """
         
-        body = self.student_state_json #  body = {"student_state_json": self.student_state_json, "result": "success"}  это не работает!!!  отдавалось:'{"'
+        body = self.load_student_state() #  body = {"student_state_json": self.student_state_json, "result": "success"}  это не работает!!!  отдавалось:'{"'
 
-        response = Response(body=body, content_type='application/json' )
-        return response
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        etag = 'state-%d-%s' % (self.student_state_version, hashlib.sha1(body or '').hexdigest())
+        return conditional_response(request, etag, body=body, content_type='application/json')
 
 
 
@@ -513,52 +653,73 @@ class MultiEngineXBlock(XBlock):
     def send_scenario(self, request, suffix=''):
         """
         Отправляет сценарий пользователю.
-        """
-        scenarios = self.load_scenarios()
-        if smart_text(self.scenario) in scenarios:
-            context = {}
-            _sc_keys = self.load_scenarios("get")
-            for key in _sc_keys:
-                key = key.strip(':')
-                if key in scenarios[smart_text(self.scenario)]:
-                    context[key] = scenarios[smart_text(self.scenario)][key].strip()
-           
+        Сценарий закрепленного блока по URL с его версией (suffix) не меняется,
+        поэтому кешируется браузером и CDN без повторной проверки.
+        """
+        scenarios_root = self.scenarios_root()
+        inline = request is not None and bool(request.GET.get('inline'))
+        body = json.dumps(self.scenario_context(scenarios_root, inline))
+        version = self.scenario_version()
+        # Пока закрепленная версия выгружается, отдается активная, и кешировать ее нельзя
+        immutable = version is not None and suffix == version and scenarios_root != self.SCENARIOS_ROOT
+        if immutable:
+            etag = version + ('-inline' if inline else '')
         else:
-            context = {
-                "name": '',
-                "html": 'Scenario not found',
-                "css": '',
-                "javascriptStudent": '',
-                "javascriptStudio": '',
-                "description": '',
-                "cssStudent": '',
-            }
-            
-        response = Response(body=json.dumps(context), content_type='text/plain')
-
+            etag = hashlib.sha1((read_head_sha(scenarios_root) or '') + body).hexdigest()
+        if request is not None and 'gzip' in request.headers.get('Accept-Encoding', ''):
+            response = conditional_response(request, etag + '-gzip', body=gzip_payload(etag, body),
+                                            content_type='text/plain', content_encoding='gzip')
+        else:
+            response = conditional_response(request, etag, body=body, content_type='text/plain')
+        response.vary = ('Accept-Encoding',)
+        if immutable:
+            response.cache_control = 'public, max-age=%d, immutable' % SCENARIO_CACHE_MAX_AGE
         return response
 
     @XBlock.handler
     def update_scenarios_repo(self, request, suffix=''):
         """
         Обновление репозитория сценариев из внешнего git-репозитория.
+        Обновление выполняется в фоновом потоке, обработчик сразу
+        возвращает id задачи (см. scenarios_sync_status).
         """
         #require(self.is_course_staff())  # TODO Узнать почему 403 в Студии
-        if self.is_repo():
-            try:
-                self.update_local_repo()
-            except:
-                self.clean_repo_path()
-                logger.debug("[MultiEngineXBlock]: " + "Clean repo path")
-                self.clone_repo()
-                logger.debug("[MultiEngineXBlock]: " + "Cloning repo...")
-        elif not self.is_repo():
-            self.clone_repo()
-            logger.debug("[MultiEngineXBlock]: " + "Cloning repo...")
-
-        response = Response(body='{"result": "success"}', content_type='application/json' )
+        job_id = repository.enqueue_sync(self.SCENARIOS_STORE)
+
+        response = Response(body=json.dumps({"result": "queued", "job_id": job_id}), content_type='application/json' )
         return response
 
+    @XBlock.handler
+    def scenarios_sync_status(self, request, suffix=''):
+        """
+        Статус задачи обновления репозитория сценариев: этап, прогресс
+        и коммит, полученный в результате.
+        """
+        job = repository.get_sync_job(request.GET.get('job_id', ''))
+        if job is None:
+            return Response(body='{"result": "not_found"}', status=404, content_type='application/json')
+        job["result"] = "success"
+        return Response(body=json.dumps(job), content_type='application/json')
+
+    @XBlock.handler
+    def prometheus_metrics(self, request, suffix=''):
+        """
+        Метрики процесса в текстовом формате Prometheus (только для персонала).
+        Каждый процесс ведет свои метрики; сводные данные по всем
+        процессам дает отправка в StatsD (STATSD_HOST в settings.py).
+        """
+        require(self.is_course_staff())
+        return Response(body=metrics.render_prometheus().encode('utf-8'),
+                        content_type='text/plain; version=0.0.4', charset='utf-8')
+
+    @XBlock.json_handler
+    def scenarios_cache_stats(self, data, suffix=''):
+        """
+        Счетчики кеша сценариев текущего процесса (только для персонала).
+        """
+        require(self.is_course_staff())
+        return get_registry(self.SCENARIOS_ROOT).stats()
+
     # Deprecated
     @XBlock.handler
     def download_scenario(self, request, suffix=''):
@@ -567,17 +728,33 @@ class MultiEngineXBlock(XBlock):
         Хендлер выгрузки файла сценария.
         """
         if self.scenario:
-            return self.download(self.SCENARIOS_ROOT, self.scenario + '.sc')
+            return self.download(self.scenarios_root(), self.scenario + '.sc')
 
     @XBlock.json_handler
     def studio_submit(self, data, suffix=''):
+        max_student_state_size = self.max_student_state_size
+        if 'max_student_state_size' in data:
+            try:
+                max_student_state_size = int(data['max_student_state_size'] or 0)
+            except (TypeError, ValueError):
+                raise JsonHandlerError(400, "Bad max student state size")
+            if max_student_state_size < 0:
+                raise JsonHandlerError(400, "Bad max student state size")
         self.display_name = data.get('display_name')
         self.question = data.get('question')
         self.weight = data.get('weight')
         self.correct_answer = data.get('correct_answer')
         self.sequence = data.get('sequence')
+        scenario_changed = data.get('scenario') != self.scenario
         self.scenario = data.get('scenario')
+        # Версия закрепляется при первом закреплении, смене сценария
+        # или по явному запросу автора
+        if not data.get('pin_scenario'):
+            self.unpin_scenario()
+        elif not self.scenario_commit or scenario_changed or data.get('bump_scenario'):
+            self.pin_scenario()
         self.max_attempts = data.get('max_attempts')
+        self.max_student_state_size = max_student_state_size
         self.student_view_template = data.get('student_view_template')
         return {'result': 'success'}
 
@@ -589,198 +766,18 @@ class MultiEngineXBlock(XBlock):
         student_answer = student_json["answer"]
         self.answer = data
 
-        correct_json = json.loads(self.correct_answer)
-        correct_answer = correct_json["answer"]
-
-        try:
-            settings = correct_json["settings"]
-        except:
-            settings = {}
-
-        settings['sequence'] = self.sequence
-
-        def multicheck(student_answer, correct_answer, settings):
-            """
-            Сравнивает 2 словаря вида:
-                {"name1": ["param1", "param2"], "name2": ["param3", "param4"]}
-            с произвольным количеством ключей,
-
-            возвращает долю совпавших значений.
-            """
-
-            keywords = ('or', 'and', 'not', 'or-and')
-
-            def max_length(lst):
-                length = 0
-                for element in lst:
-                    if len(element) > length:
-                        length = len(element)
-                return length
-
-            def _compare_answers_not_sequenced(student_answer, correct_answer, checked=0, correct=0):
-
-                fail = False
-
-                right_answers = []
-                wrong_answers = []
-
-                correct_answers_list = []
-                student_answers_list = []
-                for key in student_answer:
-                    student_answers_list += student_answer[key]
-
-                for key in correct_answer:
-                    for value in correct_answer[key]:
-                        with_keyword = False
-                        if value in keywords:
-                            if value == "or":
-                                keyword = value
-                                correct_values = correct_answer[key][keyword]
-                                for correct_value in correct_values:
-                                    correct_answers_list += correct_value
-                                    if len(set(correct_value) - set(student_answer[key])) == 0:
-                                        with_keyword = True
-                                        break
-                                if with_keyword:
-                                    checked += len(student_answer[key])
-                                    correct += len(student_answer[key])
-                                else:
-                                    checked += len(student_answer[key])
-                            elif value == "or-and":
-                                keyword = value
-                                max_points_current = 0
-                                correct_variant_len = 0
-                                checked_objects = []
-                                student_answer_key = set(student_answer[key])
-                                for obj in correct_answer[key][keyword]:
-                                    if len(set(obj)) > max_points_current:
-                                        max_points_current = len(set(obj))
-
-                                max_entry_variant = 0
-                                for obj in correct_answer[key][keyword]:
-
-                                    correct_answers_list += obj
-
-                                    if max_entry_variant < len(set(obj)):
-                                        max_entry_variant = len(set(obj))
-                                        correct_variant_len = max_points_current = len(correct_answer[key][keyword])
-
-                                    for answer in copy.deepcopy(student_answer_key):
-
-                                        if answer in obj and obj not in checked_objects:
-                                            correct += 1
-                                            checked_objects.append(obj)
-                                        elif answer not in obj:
-                                            pass
-                                        else:
-                                            fail = True
-                                checked += correct_variant_len
-
-                        elif value in student_answer[key]:
-                            correct_answers_list.append(value)
-                            right_answers.append(value)
-                            checked += 1
-                            correct += 1
-                        else:
-                            correct_answers_list.append(value)
-                            wrong_answers.append(value)
-                            checked += 1
-
-                if len(set(student_answers_list) - set(correct_answers_list)) or fail:
-                    print(set(student_answers_list))
-                    print(set(correct_answers_list))
-                    correct = 0
-
-                checks = {"result": correct / float(checked),
-                          "right_answers": right_answers,
-                          "wrong_answers": wrong_answers,
-                          "checked": checked
-                          }
-                return checks
-
-            def _compare_answers_sequenced(student_answer, correct_answer, checked=0, correct=0):
-                """
-                Вычисляет долю выполненных заданий с учетом
-                последовательности элементов в области.
-                """
-                right_answers = []
-                wrong_answers = []
-
-                answer_condition = False
-
-                for key in correct_answer:
-                    student_answer_true = []
-
-                    if not isinstance(correct_answer[key], dict):
-                        for answer_item in student_answer[key]:
-                            if answer_item in correct_answer[key]:
-                                student_answer_true.append(answer_item)
-
-                        try:
-                            answer_condition = ''.join(student_answer_true) == ''.join(correct_answer[key])
-                        except:
-                            answer_condition = str(student_answer_true) == str(correct_answer[key])
-
-                        if answer_condition:
-                            right_answers += student_answer_true
-                            correct += len(correct_answer[key])
-                        else:
-                            wrong_answers += student_answer_true
-                        checked += len(correct_answer[key])
-
-                    else:
-                        for keyword in keywords:
-                            if keyword in correct_answer[key].keys():
-                                correct_values = correct_answer[key][keyword]
-
-                                for correct_value in correct_values:
-                                    try:
-                                        answer_condition = ''.join(student_answer[key]) == ''.join(correct_value)
-                                    except:
-                                        answer_condition = str(student_answer[key]) == str(correct_value)
-                                    if answer_condition:
-                                        break
-
-                                checked += max_length(correct_values)
-
-                                if answer_condition:
-                                    right_answers += student_answer[key]
-                                    correct += len(student_answer[key])
-                                else:
-                                    wrong_answers += student_answer[key]
-
-                checks = {"result": correct / float(checked),
-                        "right_answers": right_answers,
-                        "wrong_answers": wrong_answers,
-                        }
-                return checks
-
-            def _result_postproduction(result):  # , settings['postproduction_rule']=None):
-                result = int(round(result * self.weight))
-
-                return result
-
-            if settings['sequence'] is True:
-                checks = _compare_answers_sequenced(student_answer, correct_answer)
-            elif settings['sequence'] is False:
-                checks = _compare_answers_not_sequenced(student_answer, correct_answer)
-            else:
-                pass
-
-            return _result_postproduction(checks["result"]), checks["right_answers"], checks["wrong_answers"]
-
         if answer_opportunity(self):
-            checks = multicheck(student_answer, correct_answer, settings)
-            correct = checks[0]
-            right_answers = checks[1]
-            wrong_answers = checks[2]
+            # Правильный ответ компилируется один раз и берется из кеша
+            with metrics.timer('grading'):
+                answer_key = compile_answer_key(self.correct_answer, self.sequence)
+                checks = answer_key.check(student_answer)
+            correct = weighted_points(checks["result"], self.weight)
+            right_answers = checks["right_answers"]
+            wrong_answers = checks["wrong_answers"]
             self.points = correct
             self.attempts += 1
 
-            self.runtime.publish(self, 'grade', {
-                'value': correct,
-                'max_value': self.weight,
-            })
+            self.publish_grade()
 
             return {'result': 'success',
                     'correct': correct,
@@ -793,6 +790,31 @@ class MultiEngineXBlock(XBlock):
         else:
             return('Max attempts exception!')
 
+    def publish_grade(self, force=False):
+        """
+        Публикация оценки студента, если points или weight изменились
+        с момента последней публикации (или принудительно).
+        """
+        if self.points is None:
+            return False
+        grade = {
+            'value': self.points,
+            'max_value': self.weight,
+        }
+        if not force and grade == self.published_grade:
+            return False
+        self.runtime.publish(self, 'grade', grade)
+        self.published_grade = grade
+        return True
+
+    @XBlock.json_handler
+    def republish_grade(self, data, suffix=''):
+        """
+        Повторная публикация текущей оценки студента.
+        """
+        published = self.publish_grade(force=True)
+        return {'result': 'success', 'published': published}
+
     def past_due(self):
             """
             Проверка, истекла ли дата для выполнения задания.
@@ -853,8 +875,21 @@ def _resource(path):  # pragma: NO COVER
     """
     Handy helper for getting resources from our kit.
     """
-    data = pkg_resources.resource_string(__name__, path)
-    return data.decode("utf8")
+    return load_resource(path)
+
+
+_templates = {}
+
+
+def get_template(template_path):
+    """
+    Compiled template by resource path, cached per process.
+    With RELOAD_RESOURCES enabled the template is recompiled on every call.
+    """
+    template = _templates.get(template_path)
+    if template is None or RELOAD_RESOURCES:
+        template = _templates[template_path] = Template(load_resource(template_path))
+    return template
 
 
 def render_template(template_path, context=None):
@@ -864,20 +899,72 @@ def render_template(template_path, context=None):
     if context is None:
         context = {}
 
-    template_str = load_resource(template_path)
-    template = Template(template_str)
-    return template.render(Context(context))
+    started = time.time()
+    template = get_template(template_path)
+    compiled = time.time()
+    result = template.render(Context(context))
+    finished = time.time()
+    metrics.observe('render_template', finished - started, template=template_path)
+    logger.debug("[MultiEngineXBlock]: " + "Rendered %s: compile %.2f ms, render %.2f ms" % (
+        template_path, (compiled - started) * 1000, (finished - compiled) * 1000))
+    return result
+
+
+def _scenario_cache_metrics():
+    """
+    Счетчики кеша сценариев процесса для метрик.
+    """
+    stats = get_registry(MultiEngineXBlock.SCENARIOS_ROOT).stats()
+    return {
+        'scenario_cache_hits': stats['hits'],
+        'scenario_cache_misses': stats['misses'],
+    }
+
+
+metrics.add_collector(_scenario_cache_metrics)
+
+
+_resources = {}
 
 
 def load_resource(resource_path):
     """
-    Gets the content of a resource
+    Gets the content of a resource.
+    The resource is read and decoded once per process
+    (on every call with RELOAD_RESOURCES enabled).
     """
+    if not RELOAD_RESOURCES and resource_path in _resources:
+        return _resources[resource_path]
     try:
         resource_content = pkg_resources.resource_string(__name__, resource_path)
-        return smart_text(resource_content)
     except EnvironmentError:
         logger.debug("[MultiEngineXBlock]: " + "Probably not found static resource!")
+        return None
+    resource_content = _resources[resource_path] = smart_text(resource_content)
+    return resource_content
+
+
+def embed_json(value):
+    """
+    JSON text that is safe to embed into an HTML <script> element:
+    <, > and & are written as \\u escapes, so the value can not close the tag.
+    """
+    return json.dumps(value).replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026')
+
+
+def conditional_response(request, etag, **kwargs):
+    """
+    Response with a strong ETag; 304 Not Modified if the client
+    already has this version (If-None-Match).
+    Clients are asked to revalidate on every use.
+    """
+    if request is not None and etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(**kwargs)
+    response.etag = etag
+    response.cache_control = 'private, no-cache'
+    return response
 
 
 def require(assertion):
@@ -0,0 +1,621 @@
+# -*- coding: utf-8 -*-
+"""Хранилище сценариев MultiEngineXBlock.
+Клонирование и обновление выполняются в фоновом потоке, а не в обработчике
+запроса. Статус задач хранится в кеше Django и доступен всем процессам.
+
+Хранилище (SCENARIOS_STORE, см. settings.py) общее для всех процессов узла:
+
+    repo/               рабочий git-репозиторий, меняется только под блокировкой
+    objects/<sha1>      содержимое файлов, по одному экземпляру на версию файла
+    snapshots/<commit>  неизменяемые версии: жесткие ссылки на objects/
+    current             ссылка на активную версию
+    previous            ссылка на предыдущую версию (ее еще могут дочитывать)
+    pins/<commit>/<id>  отметки блоков, закрепленных за версией: аренда,
+                        которая продлевается при показе блока; версия
+                        с действующими отметками не удаляется
+
+Новая версия публикуется атомарной заменой ссылки current, поэтому читатели
+никогда не видят частично обновленный репозиторий. Версии, на которые нет
+ссылок, и неиспользуемые объекты удаляются после каждой синхронизации.
+Пустое хранилище заполняется из прежнего каталога public/scenarios пакета."""
+
+import Queue
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import stat
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+
+import git
+from django.core.cache import cache
+
+import metrics
+from settings import GIT_REPO_URL, GIT_BRANCH, GIT_DEPTH, PIN_LEASE_TIME, PIN_RENEW_INTERVAL
+from scenarios import (
+    ASSET_SECTIONS, ASSETS_DIRNAME, REVISION_FILENAME,
+    build_index, get_registry, parse_scenarios, read_head_sha, render_asset,
+)
+
+logger = logging.getLogger(__name__)
+
+SYNC_JOB_TIMEOUT = 24 * 60 * 60
+
+LOCK_FILENAME = '.lock'
+
+ASSET_NAME_RE = re.compile(r'^[0-9a-f]{40}\.(js|css)$')
+
+
+def repo_path(store):
+    return os.path.join(store, 'repo')
+
+
+def current_path(store):
+    return os.path.join(store, 'current')
+
+
+def snapshot_path(store, commit):
+    return os.path.join(store, 'snapshots', commit)
+
+
+def is_repo(scenarios_root):
+    """
+    Проверка, является ли каталог сценариев git-репозиторием.
+    """
+    return os.path.exists(os.path.join(scenarios_root, '.git'))
+
+
+def clean_repo_path(scenarios_root):
+    """
+    Удаление локального репозитория сценариев
+    """
+    shutil.rmtree(scenarios_root, ignore_errors=True)
+
+
+@metrics.timed('git_fetch')
+def update_local_repo(scenarios_root, progress=None, branch=GIT_BRANCH, depth=GIT_DEPTH):
+    """
+    Обновление локального репозитория сценариев.
+    Забирается только последний коммит ветки (shallow fetch), рабочая копия
+    переводится на него сразу, без обхода истории.
+    Возвращает True, если репозиторий уже был актуален.
+    """
+    scenarios_repo = git.Repo(scenarios_root)
+    origin = scenarios_repo.remote('origin')
+    refspec = '+refs/heads/%s:refs/remotes/origin/%s' % (branch, branch)
+    info = origin.fetch(refspec, progress=progress, depth=depth)[0]
+    remote_commit = info.commit
+    if scenarios_repo.head.commit.hexsha == remote_commit.hexsha:
+        return True
+
+    scenarios_repo.head.reset(remote_commit, index=True, working_tree=True)
+    return False
+
+
+@metrics.timed('git_clone')
+def clone_repo(scenarios_root, progress=None, repo_url=GIT_REPO_URL, branch=GIT_BRANCH, depth=GIT_DEPTH):
+    """
+    Клонирование репозитория со сценариями.
+    Адрес репозитория хранится в переменной GIT_REPO_URL в settings.py.
+    Клонируется только ветка GIT_BRANCH на глубину GIT_DEPTH коммитов.
+    """
+    scenarios_repo = git.Repo.clone_from(
+        repo_url,
+        scenarios_root,
+        branch=branch,
+        depth=depth,
+        single_branch=True,
+        progress=progress
+    )
+    latest = True
+    return scenarios_repo, latest
+
+
+def sync_repo(store, progress=None, repo_url=GIT_REPO_URL, branch=GIT_BRANCH):
+    """
+    Обновление репозитория и публикация его текущего коммита как версии.
+    Синхронизация выполняется под файловой блокировкой: если она уже идет
+    в другом процессе, функция дожидается ее окончания и возвращает
+    ее результат вместо повторного обращения к git.
+    Возвращает хеш опубликованного коммита.
+    """
+    if not os.path.isdir(store):
+        os.makedirs(store)
+
+    with open(os.path.join(store, LOCK_FILENAME), 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as exc:
+            if exc.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+            logger.debug("[MultiEngineXBlock]: " + "Waiting for concurrent scenarios sync")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return read_head_sha(current_path(store))
+        try:
+            with metrics.timer('scenarios_sync'):
+                commit = _sync_locked(store, progress, repo_url, branch)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    get_registry(current_path(store) + '/').invalidate()
+    return commit
+
+
+def _sync_locked(store, progress, repo_url, branch):
+    repo_dir = repo_path(store)
+    if is_repo(repo_dir):
+        try:
+            update_local_repo(repo_dir, progress, branch)
+        except Exception:  # pylint: disable=broad-except
+            clean_repo_path(repo_dir)
+            logger.debug("[MultiEngineXBlock]: " + "Clean repo path")
+            clone_repo(repo_dir, progress, repo_url, branch)
+            logger.debug("[MultiEngineXBlock]: " + "Cloning repo...")
+    else:
+        clean_repo_path(repo_dir)
+        clone_repo(repo_dir, progress, repo_url, branch)
+        logger.debug("[MultiEngineXBlock]: " + "Cloning repo...")
+
+    commit = read_head_sha(repo_dir)
+    snapshot = snapshot_path(store, commit)
+    if not os.path.isdir(snapshot):
+        _make_snapshot(store, repo_dir, snapshot, commit)
+    _publish(store, snapshot)
+    collect_garbage(store)
+    return commit
+
+
+def seed_store(store, legacy_root):
+    """
+    Первая версия хранилища из прежнего каталога сценариев пакета
+    (public/scenarios), чтобы после перехода на хранилище блоки не остались
+    без сценариев до первой синхронизации. Выполняется, только если
+    в хранилище еще нет активной версии и блокировка свободна.
+    Возвращает хеш опубликованного коммита или None.
+    """
+    current = current_path(store)
+    if os.path.islink(current):
+        return read_head_sha(current)
+    legacy_root = os.path.realpath(legacy_root)
+    commit = read_head_sha(legacy_root)
+    if not commit:
+        return None
+    if not os.path.isdir(store):
+        os.makedirs(store)
+
+    with open(os.path.join(store, LOCK_FILENAME), 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as exc:
+            if exc.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+            # Версию уже публикует синхронизация или другой процесс
+            return None
+        try:
+            if os.path.islink(current):
+                return read_head_sha(current)
+            snapshot = snapshot_path(store, commit)
+            if not os.path.isdir(snapshot):
+                _make_snapshot(store, legacy_root, snapshot, commit)
+            _publish(store, snapshot)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    get_registry(current + '/').invalidate()
+    logger.debug("[MultiEngineXBlock]: " + "Seeded scenarios store from " + legacy_root)
+    return commit
+
+
+def ensure_snapshot(store, commit, owner, repo_url=GIT_REPO_URL):
+    """
+    Путь к версии для коммита, закрепленной за блоком owner.
+    Если на этом узле такой версии нет (например, коммит закрепили на другом
+    узле), она собирается из архива коммита, при необходимости догружая его
+    из внешнего репозитория.
+    Ждет блокировку хранилища и обращается к git, поэтому вызывается
+    фоновым потоком (см. find_snapshot), а не из обработчика запроса.
+    """
+    snapshot = snapshot_path(store, commit)
+    if os.path.isdir(snapshot) and is_pinned(store, commit, owner):
+        return snapshot
+    if not os.path.isdir(store):
+        os.makedirs(store)
+
+    with open(os.path.join(store, LOCK_FILENAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if not os.path.isdir(snapshot):
+                _export_snapshot(store, commit, repo_url)
+            pin_snapshot(store, commit, owner)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return snapshot
+
+
+def _export_snapshot(store, commit, repo_url):
+    repo_dir = repo_path(store)
+    if not is_repo(repo_dir):
+        clean_repo_path(repo_dir)
+        clone_repo(repo_dir, repo_url=repo_url)
+    scenarios_repo = git.Repo(repo_dir)
+    try:
+        scenarios_repo.git.cat_file('-e', commit + '^{commit}')
+    except git.GitCommandError:
+        scenarios_repo.git.fetch('origin', commit, depth=GIT_DEPTH)
+
+    export_dir = tempfile.mkdtemp(prefix='.export-', dir=store)
+    try:
+        with tempfile.TemporaryFile() as archive:
+            scenarios_repo.archive(archive, commit, format='tar')
+            archive.seek(0)
+            tarfile.open(fileobj=archive).extractall(export_dir)
+        _make_snapshot(store, export_dir, snapshot_path(store, commit), commit)
+    finally:
+        clean_repo_path(export_dir)
+    logger.debug("[MultiEngineXBlock]: " + "Exported scenarios version " + commit)
+
+
+def _store_object(store, file_path=None, data=None):
+    """
+    Путь к объекту с содержимым файла (или строки data);
+    объект создается, если его еще нет.
+    """
+    digest = hashlib.sha1()
+    if data is None:
+        with open(file_path, 'rb') as source:
+            for chunk in iter(lambda: source.read(1 << 16), b''):
+                digest.update(chunk)
+    else:
+        digest.update(data)
+    objects = os.path.join(store, 'objects')
+    if not os.path.isdir(objects):
+        os.makedirs(objects)
+    object_path = os.path.join(objects, digest.hexdigest())
+    if not os.path.exists(object_path):
+        tmp_path = '%s.%s.tmp' % (object_path, uuid.uuid4().hex)
+        if data is None:
+            shutil.copyfile(file_path, tmp_path)
+        else:
+            with open(tmp_path, 'wb') as tmp_file:
+                tmp_file.write(data)
+        os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.rename(tmp_path, object_path)
+    return object_path
+
+
+def _extract_assets(store, snapshot_dir, scenarios):
+    """
+    Вынос JS и CSS сценариев в файлы .assets/<хеш>.<расширение>.
+    Имена файлов записываются в сценарий под ключом "assets".
+    """
+    assets_dir = os.path.join(snapshot_dir, ASSETS_DIRNAME)
+    if not os.path.isdir(assets_dir):
+        os.makedirs(assets_dir)
+    for scenario in scenarios.values():
+        assets = {}
+        for section in ASSET_SECTIONS:
+            if not scenario.get(section, u'').strip():
+                continue
+            name, data = render_asset(section, scenario[section])
+            asset_path = os.path.join(assets_dir, name)
+            if not os.path.exists(asset_path):
+                os.link(_store_object(store, data=data), asset_path)
+            assets[section] = name
+        scenario['assets'] = assets
+    return scenarios
+
+
+def open_asset(store, name):
+    """
+    Файл раздела сценария из любой версии хранилища.
+    """
+    if not ASSET_NAME_RE.match(name):
+        raise IOError(errno.ENOENT, "Bad scenario asset name", name)
+    candidates = [current_path(store)]
+    snapshots = os.path.join(store, 'snapshots')
+    if os.path.isdir(snapshots):
+        candidates += [os.path.join(snapshots, commit) for commit in os.listdir(snapshots)]
+    for snapshot in candidates:
+        try:
+            return open(os.path.join(snapshot, ASSETS_DIRNAME, name), 'rb')
+        except IOError:
+            continue
+    raise IOError(errno.ENOENT, "Scenario asset not found", name)
+
+
+def _make_snapshot(store, source_dir, snapshot, commit):
+    """
+    Неизменяемая версия рабочей копии без .git. Файлы, не изменившиеся
+    между версиями, — жесткие ссылки на один и тот же объект.
+    """
+    staging = '%s.%s.tmp' % (snapshot, uuid.uuid4().hex)
+    try:
+        for dirpath, dirnames, filenames in os.walk(source_dir):
+            if '.git' in dirnames:
+                dirnames.remove('.git')
+            target_dir = os.path.join(staging, os.path.relpath(dirpath, source_dir))
+            os.makedirs(target_dir)
+            for filename in filenames:
+                file_path = os.path.join(dirpath, filename)
+                if os.path.islink(file_path):
+                    os.symlink(os.readlink(file_path), os.path.join(target_dir, filename))
+                else:
+                    os.link(_store_object(store, file_path), os.path.join(target_dir, filename))
+
+        with open(os.path.join(staging, REVISION_FILENAME), 'w') as revision_file:
+            revision_file.write(commit)
+        build_index(staging, _extract_assets(store, staging, parse_scenarios(staging)))
+        os.rename(staging, snapshot)
+    finally:
+        clean_repo_path(staging)
+
+
+def _publish(store, snapshot):
+    """
+    Атомарное переключение current на новую версию;
+    прежняя версия становится previous.
+    """
+    current = current_path(store)
+    target = os.path.relpath(snapshot, store)
+    if os.path.islink(current):
+        if os.readlink(current) == target:
+            return
+        _replace_link(os.path.join(store, 'previous'), os.readlink(current))
+    _replace_link(current, target)
+    logger.debug("[MultiEngineXBlock]: " + "Published scenarios version " + os.path.basename(snapshot))
+
+
+def _replace_link(link_path, target):
+    tmp_link = '%s.%s.tmp' % (link_path, uuid.uuid4().hex)
+    os.symlink(target, tmp_link)
+    os.rename(tmp_link, link_path)
+
+
+def _pin_path(store, commit, owner=None):
+    if owner is None:
+        return os.path.join(store, 'pins', commit)
+    return os.path.join(store, 'pins', commit, owner)
+
+
+def _pin_age(store, commit, owner):
+    """
+    Время с последнего продления отметки блока owner (None — отметки нет).
+    """
+    try:
+        return time.time() - os.path.getmtime(_pin_path(store, commit, owner))
+    except OSError:
+        return None
+
+
+def is_pinned(store, commit, owner):
+    age = _pin_age(store, commit, owner)
+    return age is not None and age <= PIN_LEASE_TIME
+
+
+def pin_snapshot(store, commit, owner):
+    """
+    Защита версии от удаления сборщиком мусора, пока за ней закреплен
+    блок owner. Отметка действует PIN_LEASE_TIME с последнего вызова.
+    """
+    while True:
+        try:
+            os.makedirs(_pin_path(store, commit))
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        try:
+            open(_pin_path(store, commit, owner), 'a').close()
+            os.utime(_pin_path(store, commit, owner), None)
+            return
+        except IOError as exc:
+            # Каталог отметок удалил unpin_snapshot последнего блока
+            if exc.errno != errno.ENOENT:
+                raise
+
+
+def unpin_snapshot(store, commit, owner):
+    """
+    Снятие отметки блока owner. Версия без отметок удаляется
+    при следующей сборке мусора, если на нее не ссылается current/previous.
+    """
+    try:
+        os.remove(_pin_path(store, commit, owner))
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+    try:
+        os.rmdir(_pin_path(store, commit))
+    except OSError as exc:
+        if exc.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+            raise
+
+
+def collect_garbage(store):
+    """
+    Удаление версий, на которые не ссылаются current и previous и за
+    которыми не закреплен ни один блок, и объектов, которые не входят
+    ни в одну версию. Отметки, которые дольше PIN_LEASE_TIME никто
+    не продлевал (блок больше не показывается с этой версией), снимаются.
+    """
+    referenced = set()
+    for link in (current_path(store), os.path.join(store, 'previous')):
+        if os.path.islink(link):
+            referenced.add(os.path.basename(os.path.realpath(link)))
+    pins = os.path.join(store, 'pins')
+    if os.path.isdir(pins):
+        for commit in os.listdir(pins):
+            try:
+                owners = os.listdir(_pin_path(store, commit))
+            except OSError:
+                continue
+            for owner in owners:
+                if is_pinned(store, commit, owner):
+                    referenced.add(commit)
+                else:
+                    unpin_snapshot(store, commit, owner)
+
+    snapshots = os.path.join(store, 'snapshots')
+    if os.path.isdir(snapshots):
+        for name in os.listdir(snapshots):
+            if name not in referenced:
+                clean_repo_path(os.path.join(snapshots, name))
+
+    # У объекта, не входящего ни в одну версию, осталась единственная ссылка
+    objects = os.path.join(store, 'objects')
+    if os.path.isdir(objects):
+        for name in os.listdir(objects):
+            object_path = os.path.join(objects, name)
+            if os.lstat(object_path).st_nlink <= 1:
+                os.remove(object_path)
+
+
+def _job_key(job_id):
+    return 'multiengine.scenarios_sync.%s' % job_id
+
+
+def get_sync_job(job_id):
+    """
+    Статус задачи синхронизации:
+    {"status": queued|running|success|error, "stage", "progress", "commit", "error"}.
+    """
+    return cache.get(_job_key(job_id))
+
+
+def _update_sync_job(job_id, **fields):
+    job = cache.get(_job_key(job_id)) or {}
+    job.update(fields)
+    cache.set(_job_key(job_id), job, SYNC_JOB_TIMEOUT)
+
+
+class SyncProgress(git.RemoteProgress):
+    """
+    Передача прогресса git clone / fetch в статус задачи.
+    """
+
+    STAGES = {
+        git.RemoteProgress.COUNTING: 'counting',
+        git.RemoteProgress.COMPRESSING: 'compressing',
+        git.RemoteProgress.RECEIVING: 'receiving',
+        git.RemoteProgress.RESOLVING: 'resolving',
+        git.RemoteProgress.CHECKING_OUT: 'checking_out',
+    }
+
+    def __init__(self, job_id):
+        super(SyncProgress, self).__init__()
+        self.job_id = job_id
+        self._last = None
+
+    def update(self, op_code, cur_count, max_count=None, message=''):
+        stage = self.STAGES.get(op_code & self.OP_MASK, '')
+        progress = int(100 * cur_count / max_count) if max_count else 0
+        if (stage, progress) != self._last:
+            self._last = (stage, progress)
+            _update_sync_job(self.job_id, stage=stage, progress=progress)
+
+
+_sync_queue = Queue.Queue()
+_sync_lock = threading.Lock()
+_sync_worker = None
+_active_jobs = {}
+
+
+def enqueue_sync(store):
+    """
+    Постановка синхронизации репозитория в очередь фонового потока.
+    Если синхронизация этого каталога уже ожидает или выполняется,
+    возвращается id существующей задачи.
+    """
+    return _enqueue(store, None)
+
+
+def enqueue_export(store, commit, owner):
+    """
+    Постановка выгрузки версии для коммита, закрепленной за блоком owner,
+    в очередь фонового потока (см. ensure_snapshot). Повторная постановка
+    той же версии, пока она ожидает или выполняется, возвращает id
+    существующей задачи.
+    """
+    return _enqueue(store, commit, owner)
+
+
+def _enqueue(store, commit, owner=None):
+    global _sync_worker  # pylint: disable=global-statement
+    with _sync_lock:
+        job_id = _active_jobs.get((store, commit))
+        if job_id is not None:
+            return job_id
+
+        job_id = _active_jobs[(store, commit)] = uuid.uuid4().hex
+        _update_sync_job(job_id, status='queued', stage='', progress=0, commit=commit, error=None)
+        if _sync_worker is None or not _sync_worker.is_alive():
+            _sync_worker = threading.Thread(target=_sync_worker_loop, name='multiengine-scenarios-sync')
+            _sync_worker.daemon = True
+            _sync_worker.start()
+        _sync_queue.put((job_id, store, commit, owner))
+        return job_id
+
+
+def find_snapshot(store, commit, owner):
+    """
+    Путь к версии для коммита, закрепленной за блоком owner, или None,
+    если на этом узле ее еще нет. Отсутствующая версия ставится в очередь
+    на выгрузку, поэтому обработчик запроса не ждет ни блокировки, ни git.
+    Отметка блока продлевается не чаще PIN_RENEW_INTERVAL.
+    """
+    snapshot = snapshot_path(store, commit)
+    if not os.path.isdir(snapshot):
+        enqueue_export(store, commit, owner)
+        return None
+    age = _pin_age(store, commit, owner)
+    if age is None or age > PIN_RENEW_INTERVAL:
+        pin_snapshot(store, commit, owner)
+    return snapshot
+
+
+_prepared_stores = set()
+
+
+def prepare_store(store, legacy_root):
+    """
+    Проверка хранилища при первом обращении из процесса. Если активной версии
+    нет, она заполняется из прежнего каталога сценариев пакета, а если его
+    нет — ставится в очередь синхронизация с внешним репозиторием.
+    """
+    if store in _prepared_stores:
+        return
+    try:
+        if os.path.islink(current_path(store)) or seed_store(store, legacy_root):
+            _prepared_stores.add(store)
+        elif read_head_sha(os.path.realpath(legacy_root)) is None:
+            enqueue_sync(store)
+            _prepared_stores.add(store)
+    except EnvironmentError:
+        logger.exception("[MultiEngineXBlock]: " + "Scenarios store %s is not available" % store)
+        _prepared_stores.add(store)
+
+
+def _sync_worker_loop():
+    while True:
+        job_id, store, job_commit, owner = _sync_queue.get()
+        _update_sync_job(job_id, status='running')
+        try:
+            if job_commit is None:
+                commit = sync_repo(store, SyncProgress(job_id))
+            else:
+                ensure_snapshot(store, job_commit, owner)
+                commit = job_commit
+            _update_sync_job(job_id, status='success', progress=100, commit=commit)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("[MultiEngineXBlock]: " + "Scenarios sync failed")
+            _update_sync_job(job_id, status='error', error=repr(exc))
+        finally:
+            with _sync_lock:
+                _active_jobs.pop((store, job_commit), None)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Массовая перепроверка ответов MultiEngineXBlock.
+Используется после исправления правильного ответа в Студии: сохраненные
+ответы всех студентов проверяются заново, а исправленные баллы
+записываются в состояние блока и публикуются сигналом SCORE_PUBLISHED —
+тем же путем, что и оценка, опубликованная самим блоком (runtime.publish),
+поэтому оценки курса пересчитываются платформой."""
+
+import json
+import logging
+import multiprocessing
+
+from django.db import connections, transaction
+
+from courseware.models import StudentModule
+from lms.djangoapps.grades.signals.signals import SCORE_PUBLISHED
+from opaque_keys.edx.keys import CourseKey, UsageKey
+from xmodule.modulestore.django import modulestore
+
+from grading import compile_answer_key, grade_many, weighted_points
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+
+def find_blocks(course_id=None, usage_id=None):
+    """
+    Блоки MultiEngine: один по usage_id или все блоки курса.
+    """
+    store = modulestore()
+    if usage_id:
+        return [store.get_item(UsageKey.from_string(usage_id))]
+    return store.get_items(CourseKey.from_string(course_id), qualifiers={'category': 'multiengine'})
+
+
+def block_settings(block):
+    """
+    Настройки блока, необходимые для проверки (передаются в процессы пула).
+    """
+    return {
+        'usage_id': unicode(block.location),
+        'correct_answer': block.correct_answer,
+        'sequence': block.sequence,
+        'weight': block.weight,
+    }
+
+
+def student_module_batches(usage_id, start_after=0, batch_size=BATCH_SIZE):
+    """
+    Идентификаторы записей StudentModule блока пачками по возрастанию id.
+    """
+    ids = StudentModule.objects.filter(
+        module_state_key=UsageKey.from_string(usage_id),
+        id__gt=start_after,
+    ).order_by('id').values_list('id', flat=True)
+
+    batch = []
+    for module_id in ids.iterator():
+        batch.append(module_id)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def rescore_batch(args):
+    """
+    Перепроверка одной пачки записей StudentModule.
+    Выполняется в процессе пула.
+    """
+    settings, ids = args
+    weight = settings['weight']
+    stats = {'rescored': 0, 'changed': 0, 'skipped': 0, 'errors': 0, 'last_id': ids[-1]}
+    answer_key = compile_answer_key(settings['correct_answer'], settings['sequence'])
+    block = modulestore().get_item(UsageKey.from_string(settings['usage_id']))
+
+    with transaction.atomic():
+        modules = []
+        for module in StudentModule.objects.select_for_update().select_related('student').filter(id__in=ids):
+            state = json.loads(module.state or '{}')
+            answer = state.get('answer')
+            if not isinstance(answer, basestring) or state.get('points') is None:
+                stats['skipped'] += 1
+                continue
+            try:
+                student_answer = json.loads(answer)["answer"]
+            except (ValueError, KeyError, TypeError):
+                student_answer = None
+            modules.append((module, state, student_answer))
+
+        results = grade_many([parsed for _module, _state, parsed in modules], answer_key)
+
+        for (module, state, _student_answer), result in zip(modules, results):
+            if result is None:
+                logger.warning("[MultiEngineXBlock]: " + "Rescore failed for StudentModule %s" % module.id)
+                stats['errors'] += 1
+                continue
+
+            points = weighted_points(result, weight)
+            stats['rescored'] += 1
+            if state['points'] == points and module.grade == points and module.max_grade == weight:
+                continue
+
+            state['points'] = points
+            module.state = json.dumps(state)
+            module.save()
+            # Обработчик сигнала записывает оценку в StudentModule и
+            # запускает пересчет оценок курса (см. publish_grade блока).
+            # Оценки после смены веса в Студии тоже пересчитываются здесь:
+            # при показе блока оценка не публикуется.
+            SCORE_PUBLISHED.send(
+                sender=None,
+                block=block,
+                user=module.student,
+                raw_earned=points,
+                raw_possible=weight,
+                only_if_higher=False,
+            )
+            stats['changed'] += 1
+    return stats
+
+
+def load_checkpoint(checkpoint_path):
+    """
+    Последние обработанные id записей по блокам {usage_id: id}.
+    """
+    if not checkpoint_path:
+        return {}
+    try:
+        with open(checkpoint_path) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    if checkpoint_path:
+        with open(checkpoint_path, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+
+
+def rescore_blocks(blocks, processes=None, batch_size=BATCH_SIZE, checkpoint_path=None):
+    """
+    Перепроверка ответов по всем блокам в пуле процессов.
+    После каждой обработанной пачки позиция сохраняется в checkpoint_path,
+    повторный запуск с тем же файлом продолжает работу с этой позиции.
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    totals = {'rescored': 0, 'changed': 0, 'skipped': 0, 'errors': 0}
+
+    # Соединения с БД не должны наследоваться процессами пула
+    for connection in connections.all():
+        connection.close()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for block in blocks:
+            settings = block_settings(block)
+            usage_id = settings['usage_id']
+            batches = student_module_batches(usage_id, checkpoint.get(usage_id, 0), batch_size)
+            # imap возвращает результаты по порядку пачек, поэтому
+            # сохраненная позиция никогда не обгоняет необработанные записи
+            for stats in pool.imap(rescore_batch, ((settings, ids) for ids in batches)):
+                for key in totals:
+                    totals[key] += stats[key]
+                checkpoint[usage_id] = stats['last_id']
+                save_checkpoint(checkpoint_path, checkpoint)
+            logger.info("[MultiEngineXBlock]: " + "Rescored %s, running totals: %s" % (usage_id, totals))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return totals
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+"""Реестр сценариев MultiEngineXBlock.
+Файлы *.sc разбираются один раз на процесс и перечитываются только при смене
+коммита в репозитории сценариев или при изменении самого файла.
+При обновлении репозитория рядом со сценариями строится индекс, из которого
+отдельный сценарий читается без разбора текста *.sc."""
+
+import os
+import json
+import hashlib
+import mmap
+import threading
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+SC_KEYS = [
+    'name::',
+    'description::',
+    'html::',
+    'javascriptStudent::',
+    'javascriptStudio::',
+    'css::',
+    'cssStudent::',
+]
+
+INDEX_FILENAME = '.multiengine.idx'
+REVISION_FILENAME = '.revision'
+INDEX_MAGIC = 'MEIDX1\n'
+INDEX_OFFSET_WIDTH = 20
+
+GZIP_CACHE_SIZE = 256
+
+# Разделы сценария, которые при обновлении репозитория выносятся в отдельные
+# файлы с хешем содержимого в имени {раздел: расширение}
+ASSET_SECTIONS = {
+    'javascriptStudent': '.js',
+    'javascriptStudio': '.js',
+    'css': '.css',
+    'cssStudent': '.css',
+}
+ASSETS_DIRNAME = '.assets'
+
+# Код сценария раньше выполнялся через eval внутри функции блока и видел ее
+# локальные переменные; теперь они передаются в scope. Функция scenarioSave,
+# объявленная в сценарии Студии, возвращается наружу.
+_SCRIPT_ASSET = (
+    u'(window.MultiEngineScenarioCode = window.MultiEngineScenarioCode || {})["%s"] = function (scope) {\n'
+    u'with (scope) {\n%s\n}\n'
+    u'return {scenarioSave: typeof scenarioSave === "function" ? scenarioSave : undefined};\n'
+    u'};\n'
+)
+
+
+_SC_HEADERS = frozenset(SC_KEYS)
+_LINE_WHITESPACE = u' \t\n\r\x0b\x0c'
+
+
+def parse_scenario(scenario_path):
+    """
+    Разбор файла сценария в словарь {раздел: текст}.
+    Файл читается целиком за один проход и декодируется один раз.
+    """
+    with open(scenario_path, 'rb') as scf:
+        text = scf.read().decode('utf-8')
+    return parse_scenario_text(text)
+
+
+def parse_scenario_text(text):
+    """
+    Конечный автомат разбора текста сценария.
+    Заголовком раздела считается только строка, целиком состоящая из ключа
+    (например, "html::"). Строки раздела собираются в список и склеиваются
+    один раз; первая строка раздела, как и раньше, обрезается по краям.
+    Строки до первого заголовка игнорируются.
+    """
+    sections = {}
+    current = None
+    start = 0
+    length = len(text)
+    while start < length:
+        end = text.find(u'\n', start)
+        end = length if end == -1 else end + 1
+        line = text[start:end]
+        start = end
+
+        stripped = line.strip(_LINE_WHITESPACE)
+        if stripped in _SC_HEADERS:
+            current = sections.setdefault(stripped[:-2], [])
+        elif current is None:
+            continue
+        elif current:
+            current.append(line)
+        else:
+            current.append(stripped)
+
+    return dict((key, u''.join(lines)) for key, lines in sections.items() if lines)
+
+
+def render_asset(section, text):
+    """
+    Файл раздела сценария: (имя, содержимое в utf-8).
+    Имя файла — хеш содержимого раздела, код оборачивается в функцию,
+    зарегистрированную под этим же хешем.
+    """
+    extension = ASSET_SECTIONS[section]
+    text = text.strip()
+    asset_id = hashlib.sha1((extension + text).encode('utf-8')).hexdigest()
+    if extension == '.js':
+        text = _SCRIPT_ASSET % (asset_id, text)
+    return asset_id + extension, text.encode('utf-8')
+
+
+def parse_scenarios(scenarios_root):
+    """
+    Разбор всех сценариев каталога без кеширования {имя: содержимое}.
+    """
+    return dict(
+        (os.path.splitext(scenario_file)[0], parse_scenario(os.path.join(scenarios_root, scenario_file)))
+        for scenario_file in os.listdir(scenarios_root)
+        if scenario_file.endswith(".sc")
+    )
+
+
+def read_head_sha(scenarios_root):
+    """
+    Хеш текущего коммита локального репозитория сценариев.
+    Для версии из хранилища сценариев он записан в файле .revision,
+    для git-репозитория читается напрямую из .git, без запуска git
+    и без GitPython.
+    """
+    try:
+        with open(os.path.join(scenarios_root, REVISION_FILENAME)) as revision_file:
+            return revision_file.read().strip()
+    except EnvironmentError:
+        pass
+    git_dir = os.path.join(scenarios_root, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as head_file:
+            head = head_file.read().strip()
+    except EnvironmentError:
+        return None
+    if not head.startswith('ref:'):
+        return head
+    ref = head[len('ref:'):].strip()
+    try:
+        with open(os.path.join(git_dir, ref)) as ref_file:
+            return ref_file.read().strip()
+    except EnvironmentError:
+        pass
+    try:
+        with open(os.path.join(git_dir, 'packed-refs')) as packed_refs:
+            for line in packed_refs:
+                parts = line.strip().split(' ')
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except EnvironmentError:
+        pass
+    return None
+
+
+class ScenarioRegistry(object):
+    """
+    Кеш разобранных сценариев одного каталога.
+    Весь кеш сбрасывается при смене HEAD, отдельный файл перечитывается
+    при изменении его mtime или размера.
+    """
+
+    def __init__(self, scenarios_root):
+        self.scenarios_root = scenarios_root
+        self.hits = 0
+        self.misses = 0
+        self._head = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """
+        Полный сброс кеша (например, после удаления репозитория).
+        """
+        with self._lock:
+            self._head = None
+            self._entries = {}
+
+    def scenarios(self):
+        """
+        Словарь всех сценариев каталога {имя: содержимое}.
+        """
+        if not os.path.isdir(self.scenarios_root):
+            self.invalidate()
+            return {}
+
+        with self._lock:
+            self._check_head()
+
+            entries = {}
+            for scenario_file in os.listdir(self.scenarios_root):
+                if not scenario_file.endswith(".sc"):
+                    continue
+                scenario_path = os.path.join(self.scenarios_root, scenario_file)
+                try:
+                    stat = os.stat(scenario_path)
+                except OSError:
+                    continue
+                signature = (stat.st_mtime, stat.st_size)
+                cached = self._entries.get(scenario_file)
+                if cached is not None and cached[0] == signature:
+                    self.hits += 1
+                    entries[scenario_file] = cached
+                else:
+                    self.misses += 1
+                    entries[scenario_file] = (signature, parse_scenario(scenario_path))
+            self._entries = entries
+
+            return dict(
+                (os.path.splitext(scenario_file)[0], entry[1])
+                for scenario_file, entry in entries.items()
+            )
+
+    def scenario(self, name):
+        """
+        Один сценарий по имени или None.
+        Имя напрямую отображается в путь к файлу, разбирается только этот файл.
+        """
+        scenario_file = name + ".sc"
+        if not name or os.path.basename(scenario_file) != scenario_file:
+            return None
+        scenario_path = os.path.join(self.scenarios_root, scenario_file)
+
+        with self._lock:
+            self._check_head()
+            try:
+                stat = os.stat(scenario_path)
+            except OSError:
+                self._entries.pop(scenario_file, None)
+                return None
+            signature = (stat.st_mtime, stat.st_size)
+            cached = self._entries.get(scenario_file)
+            if cached is not None and cached[0] == signature:
+                self.hits += 1
+            else:
+                self.misses += 1
+                cached = self._entries[scenario_file] = (signature, parse_scenario(scenario_path))
+            return cached[1]
+
+    def _check_head(self):
+        head = read_head_sha(self.scenarios_root)
+        if head != self._head:
+            self._head = head
+            self._entries = {}
+
+    def stats(self):
+        """
+        Счетчики попаданий и промахов кеша.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "head": self._head,
+            "scenarios": len(self._entries),
+        }
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(scenarios_root):
+    """
+    Реестр сценариев для каталога, один на процесс.
+    """
+    with _registries_lock:
+        registry = _registries.get(scenarios_root)
+        if registry is None:
+            registry = _registries[scenarios_root] = ScenarioRegistry(scenarios_root)
+        return registry
+
+
+def build_index(scenarios_root, scenarios=None):
+    """
+    Построение индекса сценариев.
+    Формат: сигнатура, смещение заголовка, JSON каждого сценария подряд,
+    затем заголовок {"head": sha, "scenarios": {имя: [смещение, длина]}}.
+    Файл записывается во временный и атомарно переименовывается.
+    """
+    if scenarios is None:
+        scenarios = get_registry(scenarios_root).scenarios()
+
+    index_path = os.path.join(scenarios_root, INDEX_FILENAME)
+    tmp_path = '%s.%d.tmp' % (index_path, os.getpid())
+    offsets = {}
+    with open(tmp_path, 'wb') as index_file:
+        index_file.write(INDEX_MAGIC + '0' * INDEX_OFFSET_WIDTH + '\n')
+        for name, content in scenarios.items():
+            blob = json.dumps(content)
+            offsets[name] = [index_file.tell(), len(blob)]
+            index_file.write(blob)
+        header_offset = index_file.tell()
+        index_file.write(json.dumps({
+            "head": read_head_sha(scenarios_root),
+            "scenarios": offsets,
+        }))
+        index_file.seek(len(INDEX_MAGIC))
+        index_file.write(str(header_offset).zfill(INDEX_OFFSET_WIDTH))
+    os.rename(tmp_path, index_path)
+    logger.debug("[MultiEngineXBlock]: " + "Scenarios index built")
+    return index_path
+
+
+class ScenarioIndex(object):
+    """
+    Индекс сценариев, отображенный в память.
+    Заголовок читается один раз, сценарий достается срезом по смещению.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        with open(index_path, 'rb') as index_file:
+            stat = os.fstat(index_file.fileno())
+            self.signature = (stat.st_mtime, stat.st_size)
+            self._data = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError("Bad scenarios index: %s" % index_path)
+        start = len(INDEX_MAGIC)
+        header_offset = int(self._data[start:start + INDEX_OFFSET_WIDTH])
+        header = json.loads(self._data[header_offset:])
+        self.head = header["head"]
+        self.offsets = header["scenarios"]
+
+    def __contains__(self, name):
+        return name in self.offsets
+
+    def names(self):
+        return self.offsets.keys()
+
+    def get(self, name):
+        """
+        Сценарий по имени или None.
+        """
+        position = self.offsets.get(name)
+        if position is None:
+            return None
+        offset, length = position
+        return json.loads(self._data[offset:offset + length])
+
+    def close(self):
+        self._data.close()
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(scenarios_root):
+    """
+    Актуальный индекс каталога сценариев или None, если каталога или индекса
+    нет, индекс поврежден или построен для другого коммита.
+    Индекс строит только синхронизация репозитория (версия в хранилище
+    неизменяема), в обработчиках запросов он только читается.
+    """
+    if not os.path.isdir(scenarios_root):
+        return None
+    index_path = os.path.join(scenarios_root, INDEX_FILENAME)
+    head = read_head_sha(scenarios_root)
+
+    with _indexes_lock:
+        index = _indexes.get(scenarios_root)
+        try:
+            stat = os.stat(index_path)
+            signature = (stat.st_mtime, stat.st_size)
+        except OSError:
+            signature = None
+
+        if index is not None and index.signature != signature:
+            index.close()
+            index = None
+        if index is None and signature is not None:
+            try:
+                index = ScenarioIndex(index_path)
+            except (ValueError, EnvironmentError):
+                logger.debug("[MultiEngineXBlock]: " + "Broken scenarios index")
+                index = None
+        if index is not None and index.head != head:
+            logger.debug("[MultiEngineXBlock]: " + "Stale scenarios index")
+            index.close()
+            index = None
+        if index is None:
+            _indexes.pop(scenarios_root, None)
+        else:
+            _indexes[scenarios_root] = index
+        return index
+
+
+_gzip_payloads = {}
+_gzip_payloads_lock = threading.Lock()
+
+
+def gzip_payload(version, payload):
+    """
+    Gzip-вариант ответа со сценарием.
+    Сжатие выполняется один раз на версию сценария (ETag);
+    при переполнении кеш очищается целиком.
+    """
+    compressed = _gzip_payloads.get(version)
+    if compressed is None:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(payload) + compressor.flush()
+        with _gzip_payloads_lock:
+            if len(_gzip_payloads) >= GZIP_CACHE_SIZE:
+                _gzip_payloads.clear()
+            _gzip_payloads[version] = compressed
+    return compressed
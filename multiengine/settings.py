@@ -1,2 +1,66 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
 GIT_REPO_URL = 'https://github.com/MasterGowen/multiengine-scenarios.git'
-GIT_BRANCH = 'openedu.urfu'
\ No newline at end of file
+GIT_BRANCH = 'openedu.urfu'
+# Глубина клонирования и обновления репозитория сценариев (в коммитах)
+GIT_DEPTH = 1
+
+
+def _deployment_setting(name, default=None):
+    """
+    Настройка развертывания: из настроек Django (lms/cms), затем из
+    переменной окружения с тем же именем.
+    """
+    try:
+        from django.conf import settings as django_settings
+        value = getattr(django_settings, name, None)
+    except Exception:  # pylint: disable=broad-except
+        # Django не установлен или не настроен (например, в тестах)
+        value = None
+    if value is None:
+        value = os.environ.get(name, default)
+    return value
+
+
+# Каталог public/scenarios пакета, в котором сценарии хранились раньше
+LEGACY_SCENARIOS_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'public', 'scenarios')
+
+# Хранилище версий сценариев, общее для всех процессов узла и находящееся
+# вне пакета. Задается настройкой MULTIENGINE_SCENARIOS_STORE; без нее
+# используется DEFAULT_SCENARIOS_STORE.
+DEFAULT_SCENARIOS_STORE = '/var/lib/multiengine/scenarios-store'
+SCENARIOS_STORE = _deployment_setting('MULTIENGINE_SCENARIOS_STORE')
+if not SCENARIOS_STORE:
+    logger.warning(
+        "[MultiEngineXBlock]: " + "MULTIENGINE_SCENARIOS_STORE is not set, using %s" % DEFAULT_SCENARIOS_STORE
+    )
+    SCENARIOS_STORE = DEFAULT_SCENARIOS_STORE
+
+# Срок аренды отметки блока, закрепленного за версией сценариев (в секундах).
+# Отметка продлевается при показе блока, но не чаще PIN_RENEW_INTERVAL;
+# версии с отметками, которые дольше срока никто не продлевал, удаляются
+PIN_LEASE_TIME = 30 * 24 * 60 * 60
+PIN_RENEW_INTERVAL = 24 * 60 * 60
+
+# Перечитывать статические ресурсы и перекомпилировать шаблоны
+# при каждом обращении (для разработки)
+RELOAD_RESOURCES = False
+
+# Срок кеширования сценария, закрепленного за версией (ответ не меняется)
+SCENARIO_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Сохраненное состояние студента больше этого размера (в байтах) хранится сжатым
+STUDENT_STATE_COMPRESS_THRESHOLD = 4 * 1024
+# Максимальный размер состояния студента по умолчанию (0 — без ограничения)
+STUDENT_STATE_MAX_SIZE = 1024 * 1024
+
+# Границы корзин гистограмм времени выполнения (в секундах)
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Адрес StatsD для отправки метрик по UDP (None — не отправлять)
+STATSD_HOST = os.environ.get('MULTIENGINE_STATSD_HOST')
+STATSD_PORT = int(os.environ.get('MULTIENGINE_STATSD_PORT', 8125))
+STATSD_PREFIX = 'multiengine'
@@ -0,0 +1,180 @@
+/* Общий код представлений MultiEngineXBlock: объект mengine,
+   доступный сценариям, и загрузчики сценариев. Подключается перед
+   multiengine.js и multiengine_edit.js. */
+
+// Загрузки, общие для всех блоков страницы
+if(!MultiEngineScenarioAssets) var MultiEngineScenarioAssets = {};
+if(!MultiEngineScenarioCode) var MultiEngineScenarioCode = {};
+if(!MultiEngineScenarioRequests) var MultiEngineScenarioRequests = {};
+if(!MultiEngineScenarioResponses) var MultiEngineScenarioResponses = {};
+// Сценарий блока загружается, когда блок ближе к области просмотра, чем на это расстояние
+if(!MultiEngineLazyMargin) var MultiEngineLazyMargin = 300;
+
+// Объект mengine блока elementDOM
+function MultiEngineMengine(elementDOM) {
+    var mengine = {
+        id: elementDOM.getAttribute('data-usage-id'),//.split(';')[5],
+        // Объявление переменных
+        studentAnswerJSON:{},
+        studentStateJSON:'',
+        // Функция обявляемая в сцкеарии и описывающая процесс формирования обекта правильных значенией
+        genAnswerObj: function(){},
+        genJSON: function(type, dict) {
+            if (dict == undefined){
+                dict = {};
+            };
+            var objectJSON = {};
+            objectJSON[type.valueOf()] = dict;
+            return JSON.stringify(JSON.stringify(objectJSON));
+        },
+
+        forEach: function(collection, action) {
+            collection = collection || {};
+            for (var i = 0; i < collection.length; i++)
+                action(collection[i]);
+        },
+        // Функция геренации ID
+        genID: function() {
+            return 'id' + Math.random().toString(16).substr(2, 8).toUpperCase();
+        },
+        // Асинхронная загрузка: promise с текстом ответа
+        load: function(requestURL) {
+            var loading = $.Deferred();
+            $.ajax({url: requestURL, dataType: 'text'}).done(function(data) {
+                loading.resolve(data);
+            }).fail(function(xhr) {
+                console.error(xhr.statusText);
+                loading.reject(xhr);
+            });
+            return loading.promise();
+        },
+        // Загрузка сценария: promise с разобранным JSON. Одинаковые сценарии
+        // (key) загружаются один раз на страницу для всех блоков
+        loadScenario: function(requestURL, key) {
+            key = key || requestURL;
+            var loading = MultiEngineScenarioRequests[key];
+            if (!loading) {
+                loading = MultiEngineScenarioRequests[key] = $.Deferred();
+                mengine.load(requestURL).done(function(data) {
+                    loading.resolve(JSON.parse(data));
+                }).fail(function(xhr) {
+                    delete MultiEngineScenarioRequests[key];
+                    loading.reject(xhr);
+                });
+            };
+            loading.done(function(scenarioJSON) {
+                MultiEngineScenarioResponses[requestURL] = JSON.stringify(scenarioJSON);
+            });
+            return loading.promise();
+        },
+        // DEPRECATED: синхронная загрузка для старых сценариев.
+        // Уже загруженный сценарий отдается без запроса
+        getData: function(requestURL) {
+            if(requestURL){
+                if (requestURL in MultiEngineScenarioResponses) {
+                    return MultiEngineScenarioResponses[requestURL];
+                };
+                console.warn('mengine.getData is deprecated, use mengine.load');
+                var xhr = new XMLHttpRequest();
+                xhr.open("GET", requestURL, false);
+                xhr.send(null);
+                if (xhr.status !== 200) {
+                    console.error(xhr.statusText);
+                };
+                return xhr.responseText;
+            };
+        },
+        // Файлы сценариев загружаются тегами <script> и <link> один раз
+        // на страницу, даже если сценарий используется в нескольких блоках
+        loadScript: function(url) {
+            var loading = MultiEngineScenarioAssets[url];
+            if (!loading) {
+                loading = MultiEngineScenarioAssets[url] = $.Deferred();
+                var script = document.createElement('script');
+                script.src = url;
+                script.onload = function() {
+                    loading.resolve();
+                };
+                script.onerror = function() {
+                    delete MultiEngineScenarioAssets[url];
+                    loading.reject();
+                };
+                document.head.appendChild(script);
+            };
+            return loading.promise();
+        },
+        loadStyle: function(url) {
+            var loading = MultiEngineScenarioAssets[url];
+            if (!loading) {
+                loading = MultiEngineScenarioAssets[url] = $.Deferred();
+                var link = document.createElement('link');
+                link.rel = 'stylesheet';
+                link.href = url;
+                link.onload = function() {
+                    loading.resolve();
+                };
+                link.onerror = function() {
+                    delete MultiEngineScenarioAssets[url];
+                    document.head.removeChild(link);
+                    loading.reject();
+                };
+                document.head.appendChild(link);
+            };
+            return loading.promise();
+        },
+        // Вызов callback, когда блок приближается к области просмотра.
+        // Без IntersectionObserver положение блока проверяется при прокрутке
+        whenVisible: function(target, callback) {
+            if ('IntersectionObserver' in window) {
+                var observer = new window.IntersectionObserver(function(entries) {
+                    for (var i = 0; i < entries.length; i++) {
+                        if (entries[i].isIntersecting) {
+                            observer.disconnect();
+                            callback();
+                            return;
+                        };
+                    };
+                }, {rootMargin: MultiEngineLazyMargin + 'px 0px'});
+                observer.observe(target);
+                return;
+            };
+            var namespace = mengine.genID();
+            var events = 'scroll.' + namespace + ' resize.' + namespace;
+            var check = function() {
+                var rect = target.getBoundingClientRect();
+                var visible = (rect.width || rect.height) &&
+                    rect.top < window.innerHeight + MultiEngineLazyMargin &&
+                    rect.bottom > -MultiEngineLazyMargin;
+                if (visible) {
+                    $(window).unbind(events);
+                    callback();
+                };
+            };
+            $(window).bind(events, check);
+            check();
+        },
+        // Выполнение кода сценария с переменными блока (scope).
+        // Promise отклоняется, если файл сценария не загрузился
+        runScript: function(asset, scope, callback) {
+            var running = $.Deferred();
+            mengine.loadScript(asset.url).done(function() {
+                var code = MultiEngineScenarioCode[asset.id];
+                if (!code) {
+                    console.error('Scenario script is not registered: ' + asset.url);
+                    running.reject();
+                    return;
+                };
+                var hooks = code.call(window, scope) || {};
+                if (callback) {
+                    callback(hooks);
+                };
+                running.resolve(hooks);
+            }).fail(function() {
+                console.error('Scenario script loading failed: ' + asset.url);
+                running.reject();
+            });
+            return running.promise();
+        }
+    };
+    return mengine;
+}
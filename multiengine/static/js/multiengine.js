@@ -2,62 +2,18 @@
 
 if(!MultiEngineXBlockState) var MultiEngineXBlockState = {};
 
-function MultiEngineXBlock(runtime, element) {
+function MultiEngineXBlock(runtime, element, initArgs) {
     /**:SomeClass.prototype.someMethod( reqArg[, optArg1[, optArg2 ] ] )
 
         The description for ``someMethod``.
     */
     var elementDOM = element;
+    // Сценарий и состояние студента, переданные сервером во фрагменте
+    initArgs = initArgs || {};
 
     // *******
-    // MENGINE
-    var mengine = {
-        id: elementDOM.getAttribute('data-usage-id'),//.split(';')[5],
-        // Объявление переменных
-        studentAnswerJSON:{},
-        studentStateJSON:'',
-        // Функция обявляемая в сцкеарии и описывающая процесс формирования обекта правильных значенией
-        genAnswerObj: function(){},
-        genJSON: function(type, dict) {
-            if (dict == undefined){
-                dict = {};
-            };
-            var objectJSON = {};
-            objectJSON[type.valueOf()] = dict;
-            return JSON.stringify(JSON.stringify(objectJSON));
-        },
-
-        forEach: function(collection, action) {
-            collection = collection || {};
-            for (var i = 0; i < collection.length; i++)
-                action(collection[i]);
-        },
-        // Функция геренации ID
-        genID: function() {
-            return 'id' + Math.random().toString(16).substr(2, 8).toUpperCase();
-        },
-        getData: function(requestURL) {
-            if(requestURL){
-                var xhr = new XMLHttpRequest();
-                xhr.open("GET", requestURL, false);
-                xhr.send(null);
-
-                xhr.onload = function(e) {
-                    if (xhr.readyState === 4) {
-                        if (xhr.status === 200) {
-                            console.log('Data loading ... OK!');
-                        } else {
-                            console.error(xhr.statusText);
-                        }
-                    }
-                };
-                xhr.onerror = function(e) {
-                    console.error(xhr.statusText);
-                };
-                return xhr.responseText;
-            };
-        }
-    };
+    // MENGINE (см. mengine.js)
+    var mengine = MultiEngineMengine(elementDOM);
     // MENGINE
     // *******
 
@@ -158,26 +114,39 @@ function MultiEngineXBlock(runtime, element) {
     $(element).find('.update_scenarios_repo').bind('click', function() {
         $(element).find("#overlay").css("display", "block");
         var updateScenariosRepo = runtime.handlerUrl(element, 'update_scenarios_repo');
-        $.post(updateScenariosRepo).done(function(response) {
-            window.location.reload(false);
-        });
+        $.post(updateScenariosRepo).done(waitScenariosSync);
     });
 
-    //Возврат сценариев
-    var scenarioURL = runtime.handlerUrl(element, 'send_scenario');
-    var scenario = mengine.getData(scenarioURL);
-    var scenarioJSON = JSON.parse(scenario);
+    // Обновление сценариев выполняется на сервере в фоне:
+    // статус задачи опрашивается до ее завершения
+    function waitScenariosSync(response) {
+        var statusUrl = runtime.handlerUrl(element, 'scenarios_sync_status');
+        (function poll() {
+            $.getJSON(statusUrl, {job_id: response.job_id}).done(function(job) {
+                if (job.status === 'success' || job.status === 'error') {
+                    window.location.reload(false);
+                } else {
+                    setTimeout(poll, 1000);
+                }
+            }).fail(function() {
+                window.location.reload(false);
+            });
+        })();
+    };
 
-    //Получение и передача CSS в шаблон
-    setBlockHtml('scenarioStyleStudent', scenarioJSON.cssStudent);
+    var scenarioURL = runtime.handlerUrl(element, 'send_scenario', initArgs.scenario_version || '');
 
-    //Получение суденческого решения
-    var getStudentStateURL = runtime.handlerUrl(element,'get_student_state');
-    var studentState = mengine.getData(getStudentStateURL);
-    
-    // Сохранение состояния студета в mengine
-    mengine.studentStateJSON = studentState;
-   
+    // Сценарий с JS и CSS текстом, а не файлами: запасной вариант,
+    // если файлы сценария не загрузились
+    function loadInlineScenario() {
+        return mengine.loadScenario(
+            runtime.handlerUrl(element, 'send_scenario', initArgs.scenario_version || '', 'inline=1'),
+            initArgs.scenario_key ? initArgs.scenario_key + '-inline' : null
+        );
+    };
+
+    // До запуска сценария состояние не сохраняется
+    var scenarioReady = false;
 
     
 
@@ -186,28 +155,209 @@ function MultiEngineXBlock(runtime, element) {
     var handlerUrl = runtime.handlerUrl(element, 'student_submit');
 
     var saveStudentStateURL = runtime.handlerUrl(element,'save_student_state');
+    var getStudentStateURL = runtime.handlerUrl(element,'get_student_state');
 
-    $(element).find('.Save').bind('click', function() {
+    // Автосохранение состояния студента: изменения за stateSaveDelay мс
+    // собираются в одно сохранение, одновременно выполняется не больше
+    // одного запроса. Номер sequence растет с каждой отправкой, устаревшие
+    // записи сервер отбрасывает.
+    var stateSaveDelay = 1000;
+    var stateSequence = initArgs.student_state_sequence || 0;
+    var stateSaveTimer = null;
+    var stateSaveInFlight = false;
+    var stateDirty = false;
+    var stateSaveCallbacks = [];
+    // Последнее состояние, которое сервер подтвердил
+    var stateSaved = null;
+
+    function scheduleStateSave() {
+        if (!scenarioReady) {
+            return;
+        };
+        stateDirty = true;
+        clearTimeout(stateSaveTimer);
+        stateSaveTimer = setTimeout(sendStudentState, stateSaveDelay);
+    };
+
+    function flushStudentState(callback) {
+        if (!scenarioReady) {
+            return;
+        };
+        stateDirty = true;
+        if (callback) {
+            stateSaveCallbacks.push(callback);
+        };
+        clearTimeout(stateSaveTimer);
+        sendStudentState();
+    };
+
+    function sendStudentState() {
+        stateSaveTimer = null;
+        if (stateSaveInFlight || !stateDirty) {
+            return;
+        };
+        stateDirty = false;
+        var callbacks = stateSaveCallbacks;
+        stateSaveCallbacks = [];
+        var state = mengine.genJSON('state', mengine.genAnswerObj());
+        if (state === stateSaved) {
+            // Состояние не изменилось с последнего сохранения
+            for (var i = 0; i < callbacks.length; i++) {
+                callbacks[i]({});
+            };
+            return;
+        };
+        stateSaveInFlight = true;
+        stateSequence += 1;
         $.ajax({
             type: "POST",
             url: saveStudentStateURL,
-            data: mengine.genJSON('state', mengine.genAnswerObj()),
-            success: success_save
+            data: JSON.stringify({
+                state: JSON.parse(state),
+                sequence: stateSequence
+            })
+        }).done(function(result) {
+            if (result && result.sequence > stateSequence) {
+                stateSequence = result.sequence;
+            };
+            if (result && result.result === 'stale') {
+                // Сервер уже сохранил запись с большим номером (например,
+                // из другой вкладки): состояние отправляется заново
+                // со следующим после серверного номером
+                stateDirty = true;
+                stateSaveCallbacks = callbacks.concat(stateSaveCallbacks);
+                return;
+            };
+            stateSaved = state;
+            for (var i = 0; i < callbacks.length; i++) {
+                callbacks[i](result);
+            };
+        }).fail(function() {
+            // Несохраненное состояние уйдет со следующим изменением
+            stateDirty = true;
+        }).always(function(result, status) {
+            stateSaveInFlight = false;
+            if (stateSaveCallbacks.length || (result && result.result === 'stale')) {
+                // Кнопку нажали во время запроса или запись устарела
+                sendStudentState();
+            } else if (status === 'success' && stateDirty && stateSaveTimer === null) {
+                // Изменения, сделанные во время запроса
+                scheduleStateSave();
+            };
         });
+    };
+
+    mengine.saveState = scheduleStateSave;
+    $(element).bind('change input mouseup keyup touchend', function(event) {
+        if (!$(event.target).closest('.Save, .Check').length) {
+            scheduleStateSave();
+        };
+    });
+    $(document).bind('visibilitychange', function() {
+        if (document.visibilityState === 'hidden' && stateSaveTimer !== null) {
+            flushStudentState();
+        };
+    });
+
+    $(element).find('.Save').bind('click', function() {
+        flushStudentState(success_save);
     });
 
     $(element).find('.Check').bind('click', function() {
-        $.ajax({
-            type: "POST",
-            url: saveStudentStateURL,
-            data: mengine.genJSON('state', mengine.genAnswerObj()),
-            success: success_check
+        flushStudentState(success_check);
+    });
+
+    // Сценарий загружается и запускается, только когда блок приближается
+    // к области просмотра; до этого блок остается заглушкой
+    $(elementDOM).addClass('multiengine-pending');
+    mengine.whenVisible(elementDOM, startScenario);
+
+    function startScenario() {
+        //Возврат сценариев и получение суденческого решения:
+        //если сервер не передал их во фрагменте, запросы идут параллельно
+        var scenarioLoading = initArgs.scenario_json ?
+            $.Deferred().resolve(JSON.parse(initArgs.scenario_json)).promise() :
+            mengine.loadScenario(scenarioURL, initArgs.scenario_key);
+        var stateLoading = initArgs.student_state_json ?
+            $.Deferred().resolve(JSON.parse(initArgs.student_state_json) || '').promise() :
+            mengine.load(getStudentStateURL);
+
+        // Сценарий запускается, когда загружены и он, и состояние студента
+        $.when(scenarioLoading, stateLoading).always(function() {
+            $(elementDOM).removeClass('multiengine-pending');
+        }).done(runScenario).fail(function() {
+            console.error('Scenario loading failed');
         });
+    };
 
-    });
+    function runScenario(scenarioJSON, studentState) {
+        // Текст сценария, как его раньше получали сценарии через getData
+        var scenario = initArgs.scenario_json || MultiEngineScenarioResponses[scenarioURL] || JSON.stringify(scenarioJSON);
+        // Сценарий и состояние, переданные во фрагменте, mengine.getData
+        // отдает без синхронного запроса
+        MultiEngineScenarioResponses[scenarioURL] = scenario;
+        if (typeof studentState === 'string') {
+            MultiEngineScenarioResponses[getStudentStateURL] = studentState;
+        };
 
-    // Сценарий
-    eval(scenarioJSON.javascriptStudent)
+        //Получение и передача CSS в шаблон
+        var scenarioAssets = scenarioJSON.assets || {};
+        if (scenarioAssets.cssStudent) {
+            mengine.loadStyle(scenarioAssets.cssStudent.url).fail(function() {
+                loadInlineScenario().done(function(inlineJSON) {
+                    setBlockHtml('scenarioStyleStudent', inlineJSON.cssStudent);
+                });
+            });
+        } else {
+            setBlockHtml('scenarioStyleStudent', scenarioJSON.cssStudent);
+        };
+
+        // Сохранение состояния студета в mengine
+        mengine.studentStateJSON = studentState;
+        if (typeof studentState === 'string' && studentState) {
+            stateSaved = JSON.stringify(studentState);
+        };
+
+        if (scenarioAssets.javascriptStudent) {
+            mengine.runScript(scenarioAssets.javascriptStudent, {
+                runtime: runtime,
+                element: element,
+                elementDOM: elementDOM,
+                initArgs: initArgs,
+                mengine: mengine,
+                scenarioURL: scenarioURL,
+                scenario: scenario,
+                scenarioJSON: scenarioJSON,
+                studentState: studentState,
+                getStudentStateURL: getStudentStateURL,
+                handlerUrl: handlerUrl,
+                saveStudentStateURL: saveStudentStateURL,
+                downloadUrl: downloadUrl,
+                forEachInCollection: forEachInCollection,
+                childList: childList,
+                generationID: generationID,
+                generationAnswerJSON: generationAnswerJSON,
+                getValueFild: getValueFild,
+                setValueFild: setValueFild,
+                setBlockHtml: setBlockHtml,
+                success_func: success_func,
+                success_save: success_save,
+                success_check: success_check
+            }, function() {
+                scenarioReady = true;
+            }).fail(function() {
+                loadInlineScenario().done(function(inlineJSON) {
+                    eval(inlineJSON.javascriptStudent)
+                    scenarioReady = true;
+                }).fail(function() {
+                    console.error('Scenario loading failed');
+                });
+            });
+        } else {
+            eval(scenarioJSON.javascriptStudent)
+            scenarioReady = true;
+        };
+    };
 
     MultiEngineXBlockState[mengine.id.valueOf()] = function(){
         console.log(mengine.studentStateJSON);
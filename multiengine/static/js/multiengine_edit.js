@@ -1,4 +1,4 @@
-function MultiEngineXBlockEdit(runtime, element) {
+function MultiEngineXBlockEdit(runtime, element, initArgs) {
 	// Перенос DOM структуры блока в отдельную переменную
 	// HELP
 	// Запросы доступные для работы с переменноой elementDOM
@@ -9,59 +9,11 @@ function MultiEngineXBlockEdit(runtime, element) {
 
 	var elementDOM = element[0];
 
-	 // *******
-	 // MENGINE
-	var mengine = {
-        id: elementDOM.getAttribute('data-usage-id'),//.split(';')[5],
-        // Объявление переменных
-        studentAnswerJSON:{},
-        studentStateJSON:'',
-        // Функция обявляемая в сцкеарии и описывающая процесс формирования обекта правильных значенией
-        genAnswerObj: function(){},
-        genJSON: function(type, dict) {
-            if (dict == undefined){
-                dict = {};
-            };
-            var objectJSON = {};
-            objectJSON[type.valueOf()] = dict;
-            return JSON.stringify(JSON.stringify(objectJSON));
-        },
-
-        forEach: function(collection, action) {
-            collection = collection || {};
-            for (var i = 0; i < collection.length; i++)
-                action(collection[i]);
-        },
-        // Функция геренации ID
-        genID: function() {
-            return 'id' + Math.random().toString(16).substr(2, 8).toUpperCase();
-        },
-        getData: function(requestURL) {
-            if(requestURL){
-                var xhr = new XMLHttpRequest();
-                xhr.open("GET", requestURL, false);
-                xhr.send(null);
-
-                xhr.onload = function(e) {
-                    if (xhr.readyState === 4) {
-                        if (xhr.status === 200) {
-                            console.log('Data loading ... OK!');
-                        } else {
-                            console.error(xhr.statusText);
-                        }
-                    }
-                };
-                xhr.onerror = function(e) {
-                    console.error(xhr.statusText);
-                };
-                return xhr.responseText;
-            };
-        }
-
-    };
-
-    // MENGINE
-    // *******
+	// *******
+	// MENGINE (см. mengine.js)
+	var mengine = MultiEngineMengine(elementDOM);
+	// MENGINE
+	// *******
 
 	// Функция пробегания по элементам коллекции
 	function forEachInCollection(collection, action) {
@@ -165,43 +117,107 @@ function MultiEngineXBlockEdit(runtime, element) {
 	$(element).find('.update_scenarios_repo').bind('click', function() {
 		$(element).find("#overlay").css("display", "block");
 		var updateScenariosRepo = runtime.handlerUrl(element, 'update_scenarios_repo');
-		$.post(updateScenariosRepo).done(function(response) {
-			window.location.reload(false);
-		});
+		$.post(updateScenariosRepo).done(waitScenariosSync);
 	});
 
+	// Обновление сценариев выполняется на сервере в фоне:
+	// статус задачи опрашивается до ее завершения
+	function waitScenariosSync(response) {
+		var statusUrl = runtime.handlerUrl(element, 'scenarios_sync_status');
+		(function poll() {
+			$.getJSON(statusUrl, {job_id: response.job_id}).done(function(job) {
+				if (job.status === 'success' || job.status === 'error') {
+					window.location.reload(false);
+				} else {
+					setTimeout(poll, 1000);
+				}
+			}).fail(function() {
+				window.location.reload(false);
+			});
+		})();
+	};
+
 	//TODO: Подгрузка сценапия
-    scenarioURL = runtime.handlerUrl(element, 'send_scenario');
+	// У закрепленного сценария неизменяемый URL с версией, он кешируется браузером
+	initArgs = initArgs || {};
+    scenarioURL = runtime.handlerUrl(element, 'send_scenario', initArgs.scenario_version || '');
 
+	// DEPRECATED: синхронная загрузка, оставлена для старых сценариев
 	function getScenario(scenarioURL) {
-		var xhr = new XMLHttpRequest();
-		xhr.open("GET", scenarioURL, false);
-		xhr.send(null);
-
-		xhr.onload = function(e) {
-			if (xhr.readyState === 4) {
-				if (xhr.status === 200) {
-					console.error(xhr.statusText);
-				} else {
-					console.error(xhr.statusText);
-				}
-			}
-		};
-		xhr.onerror = function(e) {
-			console.error(xhr.statusText);
+		return mengine.getData(scenarioURL);
+	};
+
+	// Сценарий с JS и CSS текстом, а не файлами: запасной вариант,
+	// если файлы сценария не загрузились
+	function loadInlineScenario() {
+		return mengine.loadScenario(
+			runtime.handlerUrl(element, 'send_scenario', initArgs.scenario_version || '', 'inline=1'),
+			initArgs.scenario_key ? initArgs.scenario_key + '-inline' : null
+		);
+	};
+
+	// Выполнение кода сценария, переданного текстом
+	function evalScenario(scenarioJSON) {
+		var scenario = JSON.stringify(scenarioJSON);
+		eval(scenarioJSON.javascriptStudio);
+		// Функция, объявленная в сценарии, видна только здесь
+		if (typeof scenarioSave == 'function') {
+			scenarioHooks.scenarioSave = scenarioSave;
 		};
-		return xhr.responseText;
 	};
 
-	var scenario = mengine.getData(scenarioURL);
-	var scenarioJSON = JSON.parse(scenario);
-	
-	setBlockHtml('scenarioTemplate', scenarioJSON.html);
-	setBlockHtml('scenarioStyle', scenarioJSON.css);
-	eval(scenarioJSON.javascriptStudio);
+	var scenarioHooks = {};
+	mengine.loadScenario(scenarioURL, initArgs.scenario_key).done(function(scenarioJSON) {
+		setBlockHtml('scenarioTemplate', scenarioJSON.html);
+
+		// JS и CSS сценария подключаются файлами, если они вынесены из JSON
+		var scenarioAssets = scenarioJSON.assets || {};
+		if (scenarioAssets.css) {
+			mengine.loadStyle(scenarioAssets.css.url).fail(function() {
+				loadInlineScenario().done(function(inlineJSON) {
+					setBlockHtml('scenarioStyle', inlineJSON.css);
+				});
+			});
+		} else {
+			setBlockHtml('scenarioStyle', scenarioJSON.css);
+		};
+		if (scenarioAssets.javascriptStudio) {
+			mengine.runScript(scenarioAssets.javascriptStudio, {
+				runtime: runtime,
+				element: element,
+				elementDOM: elementDOM,
+				initArgs: initArgs,
+				mengine: mengine,
+				scenarioURL: scenarioURL,
+				scenario: JSON.stringify(scenarioJSON),
+				scenarioJSON: scenarioJSON,
+				getScenario: getScenario,
+				downloadUrl: downloadUrl,
+				forEachInCollection: forEachInCollection,
+				childList: childList,
+				generationID: generationID,
+				generationAnswerJSON: generationAnswerJSON,
+				getValueFild: getValueFild,
+				setValueFild: setValueFild,
+				setBlockHtml: setBlockHtml
+			}, function(hooks) {
+				scenarioHooks = hooks;
+			}).fail(function() {
+				loadInlineScenario().done(evalScenario).fail(function() {
+					console.error('Scenario loading failed');
+				});
+			});
+		} else {
+			evalScenario(scenarioJSON);
+		};
+	}).fail(function() {
+		console.error('Scenario loading failed');
+	});
 
 	$(element).find('.save-button').bind('click', function() {
-		if(typeof scenarioSave == 'function'){
+		if(typeof scenarioHooks.scenarioSave == 'function'){
+		    scenarioHooks.scenarioSave();
+	    } else if(typeof scenarioSave == 'function'){
 		    scenarioSave();
 	    };
 		var handlerUrl = runtime.handlerUrl(element, 'studio_submit'),
@@ -211,14 +227,23 @@ function MultiEngineXBlockEdit(runtime, element) {
 				weight: $(element).find('input[name=weight]').val(),
 				correct_answer: $(element).find('input[id=correct_answer]').val(),
 				sequence: document.getElementById("sequence").checked,
+				pin_scenario: document.getElementById("pin_scenario").checked,
+				bump_scenario: $(element).find('#bump_scenario').is(':checked'),
 				scenario: $(element).find('select[name=scenario]').val(),
 				max_attempts: $(element).find('input[name=max_attempts]').val(),
+				max_student_state_size: $(element).find('input[name=max_student_state_size]').val(),
 				student_view_json: $(element).find('input[name=student_view_json]').val(),
 				student_view_template: $(element).find('#student_view_template').val(),
 			};
 
 		$.post(handlerUrl, JSON.stringify(data)).done(function(response) {
 			window.location.reload(false);
+		}).fail(function(xhr) {
+			var message = xhr.statusText;
+			try {
+				message = JSON.parse(xhr.responseText).error || message;
+			} catch (e) {};
+			runtime.notify('error', {title: 'Unable to save', message: message});
 		});
 	});
 	$(element).find('.cancel-button').bind('click', function() {
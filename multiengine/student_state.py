@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Хранение сохраненного состояния студента (student_state_json).
+Состояние приводится к компактному JSON, а если оно больше порога,
+хранится сжатым zlib. Распаковывается состояние только при отдаче клиенту,
+поэтому клиент, как и раньше, получает JSON-строку."""
+
+import base64
+import json
+import zlib
+from collections import OrderedDict
+
+from settings import STUDENT_STATE_COMPRESS_THRESHOLD
+
+CODEC = 'zlib'
+
+
+class StudentStateTooLarge(ValueError):
+    """
+    Состояние больше допустимого для блока размера.
+    """
+
+    def __init__(self, size, max_size):
+        super(StudentStateTooLarge, self).__init__(
+            "Student state is too large: %d bytes (max %d)" % (size, max_size)
+        )
+        self.size = size
+        self.max_size = max_size
+
+
+def normalize_state(state):
+    """
+    Компактная запись состояния: JSON без лишних пробелов
+    с сохранением порядка ключей. Не JSON возвращается без изменений.
+    """
+    if not isinstance(state, basestring):
+        return state
+    try:
+        parsed = json.loads(state, object_pairs_hook=OrderedDict)
+    except ValueError:
+        return state
+    return json.dumps(parsed, separators=(',', ':'), ensure_ascii=False)
+
+
+def encode_state(state, max_size=0, threshold=STUDENT_STATE_COMPRESS_THRESHOLD):
+    """
+    Значение для поля student_state_json.
+    max_size ограничивает размер состояния в байтах до сжатия (0 — без ограничения).
+    """
+    state = normalize_state(state)
+    if not isinstance(state, basestring):
+        return state
+
+    raw = state.encode('utf-8') if isinstance(state, unicode) else state
+    if max_size and len(raw) > max_size:
+        raise StudentStateTooLarge(len(raw), max_size)
+    if len(raw) <= threshold:
+        return state
+
+    packed = base64.b64encode(zlib.compress(raw, 6))
+    if len(packed) >= len(raw):
+        return state
+    return {"codec": CODEC, "size": len(raw), "data": packed}
+
+
+def decode_state(value):
+    """
+    Исходная JSON-строка состояния из значения поля student_state_json.
+    """
+    if isinstance(value, dict) and value.get("codec") == CODEC:
+        return zlib.decompress(base64.b64decode(value["data"])).decode('utf-8')
+    return value
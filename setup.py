@@ -26,10 +26,16 @@ setup(
     description='multiengine XBlock',   # TODO: write a better description.
     packages=[
         'multiengine',
+        'multiengine.management',
+        'multiengine.management.commands',
     ],
     install_requires=[
         'XBlock',
     ],
+    extras_require={
+        # Матричная проверка ответов в grading.grade_many
+        'batch': ['numpy'],
+    },
     entry_points={
         'xblock.v1': [
             'multiengine = multiengine:MultiEngineXBlock',
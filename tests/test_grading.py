@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""Проверка ответов grading в сравнении с прежней multicheck.
+
+Случайные правильные ответы (в том числе с "or" / "or-and") и ответы
+студентов проверяются прежним алгоритмом из MultiEngineXBlock.multicheck
+и grading.AnswerKey; баллы и списки значений должны совпадать.
+
+Запуск:
+    python -m unittest discover tests
+"""
+
+import copy
+import json
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'multiengine'))
+
+import grading  # noqa: E402
+
+WEIGHT = 100
+ITEMS = [u'a', u'b', u'c', u'd', u'e', u'f', u'g']
+
+
+def legacy_multicheck(student_answer, correct_answer, sequence):
+    """
+    multicheck в том виде, в каком она была в MultiEngineXBlock.student_submit
+    (вес задания WEIGHT).
+    """
+    keywords = ('or', 'and', 'not', 'or-and')
+
+    def max_length(lst):
+        length = 0
+        for element in lst:
+            if len(element) > length:
+                length = len(element)
+        return length
+
+    def _compare_answers_not_sequenced(student_answer, correct_answer, checked=0, correct=0):
+        fail = False
+        right_answers = []
+        wrong_answers = []
+        correct_answers_list = []
+        student_answers_list = []
+        for key in student_answer:
+            student_answers_list += student_answer[key]
+
+        for key in correct_answer:
+            for value in correct_answer[key]:
+                with_keyword = False
+                if value in keywords:
+                    if value == "or":
+                        keyword = value
+                        correct_values = correct_answer[key][keyword]
+                        for correct_value in correct_values:
+                            correct_answers_list += correct_value
+                            if len(set(correct_value) - set(student_answer[key])) == 0:
+                                with_keyword = True
+                                break
+                        if with_keyword:
+                            checked += len(student_answer[key])
+                            correct += len(student_answer[key])
+                        else:
+                            checked += len(student_answer[key])
+                    elif value == "or-and":
+                        keyword = value
+                        max_points_current = 0
+                        correct_variant_len = 0
+                        checked_objects = []
+                        student_answer_key = set(student_answer[key])
+                        for obj in correct_answer[key][keyword]:
+                            if len(set(obj)) > max_points_current:
+                                max_points_current = len(set(obj))
+
+                        max_entry_variant = 0
+                        for obj in correct_answer[key][keyword]:
+                            correct_answers_list += obj
+                            if max_entry_variant < len(set(obj)):
+                                max_entry_variant = len(set(obj))
+                                correct_variant_len = max_points_current = len(correct_answer[key][keyword])
+                            for answer in copy.deepcopy(student_answer_key):
+                                if answer in obj and obj not in checked_objects:
+                                    correct += 1
+                                    checked_objects.append(obj)
+                                elif answer not in obj:
+                                    pass
+                                else:
+                                    fail = True
+                        checked += correct_variant_len
+
+                elif value in student_answer[key]:
+                    correct_answers_list.append(value)
+                    right_answers.append(value)
+                    checked += 1
+                    correct += 1
+                else:
+                    correct_answers_list.append(value)
+                    wrong_answers.append(value)
+                    checked += 1
+
+        if len(set(student_answers_list) - set(correct_answers_list)) or fail:
+            correct = 0
+
+        return {"result": correct / float(checked),
+                "right_answers": right_answers,
+                "wrong_answers": wrong_answers}
+
+    def _compare_answers_sequenced(student_answer, correct_answer, checked=0, correct=0):
+        right_answers = []
+        wrong_answers = []
+        answer_condition = False
+
+        for key in correct_answer:
+            student_answer_true = []
+
+            if not isinstance(correct_answer[key], dict):
+                for answer_item in student_answer[key]:
+                    if answer_item in correct_answer[key]:
+                        student_answer_true.append(answer_item)
+                try:
+                    answer_condition = ''.join(student_answer_true) == ''.join(correct_answer[key])
+                except:  # pylint: disable=bare-except
+                    answer_condition = str(student_answer_true) == str(correct_answer[key])
+
+                if answer_condition:
+                    right_answers += student_answer_true
+                    correct += len(correct_answer[key])
+                else:
+                    wrong_answers += student_answer_true
+                checked += len(correct_answer[key])
+
+            else:
+                for keyword in keywords:
+                    if keyword in correct_answer[key].keys():
+                        correct_values = correct_answer[key][keyword]
+                        for correct_value in correct_values:
+                            try:
+                                answer_condition = ''.join(student_answer[key]) == ''.join(correct_value)
+                            except:  # pylint: disable=bare-except
+                                answer_condition = str(student_answer[key]) == str(correct_value)
+                            if answer_condition:
+                                break
+
+                        checked += max_length(correct_values)
+
+                        if answer_condition:
+                            right_answers += student_answer[key]
+                            correct += len(student_answer[key])
+                        else:
+                            wrong_answers += student_answer[key]
+
+        return {"result": correct / float(checked),
+                "right_answers": right_answers,
+                "wrong_answers": wrong_answers}
+
+    if sequence is True:
+        checks = _compare_answers_sequenced(student_answer, correct_answer)
+    else:
+        checks = _compare_answers_not_sequenced(student_answer, correct_answer)
+    return int(round(checks["result"] * WEIGHT)), checks["right_answers"], checks["wrong_answers"]
+
+
+def random_values(rnd, length=None):
+    if length is None:
+        length = rnd.randint(0, 4)
+    return [rnd.choice(ITEMS) for _ in range(length)]
+
+
+def random_correct_answer(rnd, keyword=None):
+    """
+    Правильный ответ из 1-3 областей: списки значений и варианты
+    "or" / "or-and" (если keyword не задан — вперемешку).
+    """
+    answer = {}
+    for i in range(rnd.randint(1, 3)):
+        key = u'area%d' % i
+        kind = keyword or rnd.choice(['list', 'or', 'or-and', 'mix', 'and'])
+        if kind == 'list':
+            answer[key] = random_values(rnd, rnd.randint(1, 4))
+        elif kind == 'mix':
+            answer[key] = {
+                'or': [random_values(rnd, rnd.randint(0, 3)) for _ in range(rnd.randint(1, 3))],
+                'or-and': [random_values(rnd, rnd.randint(0, 3)) for _ in range(rnd.randint(1, 3))],
+            }
+        elif kind == 'and':
+            answer[key] = {'and': [random_values(rnd)], rnd.choice(ITEMS): 1}
+        else:
+            variants = [random_values(rnd, rnd.randint(0, 3)) for _ in range(rnd.randint(0, 4))]
+            if variants and rnd.random() < 0.2:
+                variants.append(list(variants[0]))
+            answer[key] = {kind: variants}
+    return answer
+
+
+def random_student_answer(rnd, correct_answer):
+    answer = dict((key, random_values(rnd)) for key in correct_answer)
+    if rnd.random() < 0.2:
+        answer[u'extra'] = random_values(rnd)
+    return answer
+
+
+def outcome(func, *args):
+    """
+    Результат вызова или тип исключения: прежняя проверка падала
+    на некоторых ответах, новая должна падать на тех же.
+    """
+    try:
+        return 'ok', func(*args)
+    except Exception as error:  # pylint: disable=broad-except
+        return 'error', type(error).__name__
+
+
+def check_points(correct_json, student_answer, sequence):
+    checks = grading.compile_answer_key(correct_json, sequence).check(student_answer)
+    return (grading.weighted_points(checks["result"], WEIGHT),
+            checks["right_answers"], checks["wrong_answers"])
+
+
+class AnswerKeyParityTest(unittest.TestCase):
+    """
+    AnswerKey.check дает те же баллы и списки значений, что и multicheck.
+    """
+
+    CASES = 3000
+
+    def assert_parity(self, correct_answer, student_answer, sequence):
+        correct_json = json.dumps({"answer": correct_answer})
+        # Оба алгоритма получают правильный ответ, разобранный из одной
+        # json-строки, поэтому обходят области в одном порядке.
+        expected = outcome(legacy_multicheck, student_answer, json.loads(correct_json)["answer"], sequence)
+        actual = outcome(check_points, correct_json, student_answer, sequence)
+        self.assertEqual(expected, actual, "answer=%s student=%s sequence=%s" % (
+            correct_json, json.dumps(student_answer), sequence))
+
+    def assert_random_parity(self, seed, keyword=None, sequence=None):
+        rnd = random.Random(seed)
+        for _ in range(self.CASES):
+            correct_answer = random_correct_answer(rnd, keyword)
+            student_answer = random_student_answer(rnd, correct_answer)
+            self.assert_parity(
+                correct_answer, student_answer,
+                rnd.random() < 0.5 if sequence is None else sequence)
+
+    def test_or(self):
+        self.assert_random_parity(1, keyword='or', sequence=False)
+
+    def test_or_and(self):
+        self.assert_random_parity(2, keyword='or-and', sequence=False)
+
+    def test_or_and_mixed(self):
+        self.assert_random_parity(3, keyword='mix', sequence=False)
+
+    def test_sequence(self):
+        self.assert_random_parity(4, sequence=True)
+
+    def test_mixed(self):
+        self.assert_random_parity(5)
+
+    def test_or_and_duplicate_variant_fails(self):
+        correct_answer = {u'area0': {'or-and': [[u'a'], [u'b', u'a']]}}
+        self.assert_parity(correct_answer, {u'area0': [u'a', u'b']}, False)
+
+    def test_large_or_and(self):
+        rnd = random.Random(6)
+        items = [u'item%d' % i for i in range(300)]
+        correct_answer = {u'area0': {'or-and': [items[i:i + 3] for i in range(0, 300, 3)]}}
+        for _ in range(20):
+            student_answer = {u'area0': rnd.sample(items, rnd.randint(0, 150))}
+            self.assert_parity(correct_answer, student_answer, False)
+
+
+class GradeManyParityTest(unittest.TestCase):
+    """
+    grade_many (матричная проверка при наличии NumPy) дает те же баллы,
+    что и multicheck, а на ответах, где multicheck падает, — None.
+    """
+
+    def legacy_points(self, correct_json, student_answer, sequence):
+        result = outcome(legacy_multicheck, student_answer, json.loads(correct_json)["answer"], sequence)
+        return result[1][0] if result[0] == 'ok' else None
+
+    def assert_random_parity(self, seed, keyword=None, sequence=False, rounds=300):
+        rnd = random.Random(seed)
+        for _ in range(rounds):
+            correct_answer = random_correct_answer(rnd, keyword)
+            correct_json = json.dumps({"answer": correct_answer})
+            answers = [random_student_answer(rnd, correct_answer) for _ in range(rnd.randint(1, 40))]
+            if rnd.random() < 0.2:
+                answers += [{}, [1], {u'area0': 5}, {u'area0': [[u'a']]}]
+            rnd.shuffle(answers)
+
+            answer_key = grading.compile_answer_key(correct_json, sequence)
+            results = grading.grade_many(answers, answer_key, chunk_size=7)
+            actual = [None if result is None else grading.weighted_points(result, WEIGHT) for result in results]
+            expected = [self.legacy_points(correct_json, answer, sequence) for answer in answers]
+            self.assertEqual(expected, actual, "answer=%s answers=%s" % (correct_json, json.dumps(answers)))
+
+    def test_or(self):
+        self.assert_random_parity(11, keyword='or')
+
+    def test_or_and(self):
+        self.assert_random_parity(12, keyword='or-and')
+
+    def test_mixed(self):
+        self.assert_random_parity(13)
+
+    def test_sequence(self):
+        self.assert_random_parity(14, sequence=True)
+
+    def test_empty(self):
+        answer_key = grading.compile_answer_key(json.dumps({"answer": {u'area0': [u'a']}}))
+        self.assertEqual(grading.grade_many([], answer_key), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""Синхронизация хранилища сценариев с локальным зеркалом репозитория.
+
+Зеркало — временный git-репозиторий, доступный по адресу file://, поэтому
+клонирование и обновление действительно выполняются неполными (shallow),
+как с внешним репозиторием.
+
+Запуск:
+    python -m unittest discover tests
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'multiengine'))
+
+from django.conf import settings as django_settings  # noqa: E402
+
+if not django_settings.configured:
+    django_settings.configure(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+
+import repository  # noqa: E402
+from scenarios import get_index, get_registry, read_head_sha  # noqa: E402
+
+BRANCH = 'openedu.urfu'
+
+
+class MirrorTestCase(unittest.TestCase):
+    """
+    Хранилище и зеркало во временном каталоге.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='multiengine-test-')
+        self.origin = os.path.join(self.tmp, 'origin')
+        self.store = os.path.join(self.tmp, 'store')
+        self.repo_url = 'file://' + self.origin
+        os.makedirs(self.origin)
+        self.git('init', '-q')
+        self.git('checkout', '-q', '-b', BRANCH)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def git(self, *args):
+        return subprocess.check_output(
+            ('git', '-c', 'user.name=test', '-c', 'user.email=test@example.com') + args,
+            cwd=self.origin,
+        ).strip()
+
+    def commit(self, files, message='update'):
+        """
+        Коммит в зеркало: {имя файла: содержимое или None для удаления}.
+        """
+        for name, content in files.items():
+            path = os.path.join(self.origin, name)
+            if content is None:
+                self.git('rm', '-q', name)
+                continue
+            with open(path, 'w') as scenario_file:
+                scenario_file.write(content)
+            self.git('add', name)
+        self.git('commit', '-q', '-m', message)
+        return self.git('rev-parse', 'HEAD')
+
+    def sync(self):
+        return repository.sync_repo(self.store, repo_url=self.repo_url, branch=BRANCH)
+
+    def current(self):
+        return repository.current_path(self.store) + '/'
+
+    def snapshots(self):
+        return sorted(os.listdir(os.path.join(self.store, 'snapshots')))
+
+
+def scenario(name, html=u'<p>%s</p>'):
+    return 'name::\n%s\nhtml::\n%s\n' % (name, html % name)
+
+
+class SyncTest(MirrorTestCase):
+
+    def test_clone_is_shallow(self):
+        self.commit({'s1.sc': scenario('S1')}, 'c1')
+        self.commit({'s2.sc': scenario('S2')}, 'c2')
+        head = self.commit({'s3.sc': scenario('S3')}, 'c3')
+
+        self.assertEqual(self.sync(), head)
+        repo = repository.repo_path(self.store)
+        self.assertTrue(os.path.exists(os.path.join(repo, '.git', 'shallow')))
+        self.assertEqual(subprocess.check_output(['git', 'rev-list', '--count', 'HEAD'], cwd=repo).strip(), '1')
+        self.assertEqual(read_head_sha(self.current()), head)
+        self.assertEqual(sorted(get_registry(self.current()).scenarios()), ['s1', 's2', 's3'])
+        self.assertEqual(sorted(get_index(self.current()).names()), ['s1', 's2', 's3'])
+
+    def test_update_publishes_new_snapshot(self):
+        first = self.commit({'s1.sc': scenario('S1')}, 'c1')
+        self.sync()
+        second = self.commit({'s2.sc': scenario('S2')}, 'c2')
+
+        self.assertEqual(self.sync(), second)
+        self.assertEqual(read_head_sha(self.current()), second)
+        # Обновление тоже неполное: локальная история — один коммит
+        repo = repository.repo_path(self.store)
+        self.assertEqual(subprocess.check_output(['git', 'rev-list', '--count', 'HEAD'], cwd=repo).strip(), '1')
+        self.assertEqual(sorted(get_registry(self.current()).scenarios()), ['s1', 's2'])
+        self.assertEqual(os.readlink(os.path.join(self.store, 'previous')), os.path.join('snapshots', first))
+        # Неизменившийся файл — один объект на обе версии
+        self.assertEqual(
+            os.stat(os.path.join(repository.snapshot_path(self.store, first), 's1.sc')).st_ino,
+            os.stat(os.path.join(repository.snapshot_path(self.store, second), 's1.sc')).st_ino,
+        )
+
+    def test_diverged_history(self):
+        self.commit({'s1.sc': scenario('S1')}, 'c1')
+        self.commit({'s2.sc': scenario('S2')}, 'c2')
+        self.sync()
+
+        # Ветка зеркала переписана: c2 заменен коммитом, которого нет в локальной истории
+        self.git('reset', '-q', '--hard', 'HEAD~1')
+        rewritten = self.commit({'s3.sc': scenario('S3')}, 'c2 rewritten')
+
+        self.assertEqual(self.sync(), rewritten)
+        self.assertEqual(read_head_sha(repository.repo_path(self.store)), rewritten)
+        self.assertEqual(sorted(get_registry(self.current()).scenarios()), ['s1', 's3'])
+        self.assertFalse(os.path.exists(os.path.join(self.current(), 's2.sc')))
+
+    def test_unchanged_sync_keeps_snapshot(self):
+        head = self.commit({'s1.sc': scenario('S1')}, 'c1')
+        self.sync()
+        self.assertEqual(self.sync(), head)
+        self.assertEqual(self.snapshots(), [head])
+
+    def test_garbage_collection(self):
+        self.commit({'s1.sc': scenario('S1'), 'old.sc': scenario('Old')}, 'c1')
+        self.sync()
+        second = self.commit({'old.sc': None, 's2.sc': scenario('S2')}, 'c2')
+        self.sync()
+        third = self.commit({'s3.sc': scenario('S3')}, 'c3')
+        self.sync()
+
+        # first не нужна ни current, ни previous
+        self.assertEqual(self.snapshots(), sorted([second, third]))
+        objects = os.path.join(self.store, 'objects')
+        for name in os.listdir(objects):
+            self.assertGreater(os.stat(os.path.join(objects, name)).st_nlink, 1)
+        # Объекты хранятся под sha1 содержимого
+        self.assertNotIn(hashlib.sha1(scenario('Old')).hexdigest(), os.listdir(objects))
+        self.assertIn(hashlib.sha1(scenario('S1')).hexdigest(), os.listdir(objects))
+
+    def test_pinned_snapshot_survives_collection(self):
+        first = self.commit({'s1.sc': scenario('S1')}, 'c1')
+        self.sync()
+        repository.pin_snapshot(self.store, first, 'block-1')
+        repository.pin_snapshot(self.store, first, 'block-2')
+        second = self.commit({'s2.sc': scenario('S2')}, 'c2')
+        self.sync()
+        third = self.commit({'s3.sc': scenario('S3')}, 'c3')
+        self.sync()
+
+        self.assertEqual(self.snapshots(), sorted([first, second, third]))
+        # Версия удаляется, только когда за ней не закреплен ни один блок
+        repository.unpin_snapshot(self.store, first, 'block-1')
+        repository.collect_garbage(self.store)
+        self.assertIn(first, self.snapshots())
+        repository.unpin_snapshot(self.store, first, 'block-2')
+        self.assertFalse(os.path.exists(os.path.join(self.store, 'pins', first)))
+        repository.collect_garbage(self.store)
+        self.assertEqual(self.snapshots(), sorted([second, third]))
+
+    def test_expired_pin_is_collected(self):
+        first = self.commit({'s1.sc': scenario('S1')}, 'c1')
+        self.sync()
+        repository.pin_snapshot(self.store, first, 'block-1')
+        self.commit({'s2.sc': scenario('S2')}, 'c2')
+        self.sync()
+        self.commit({'s3.sc': scenario('S3')}, 'c3')
+        self.sync()
+        self.assertIn(first, self.snapshots())
+
+        # Отметку блока, который больше не показывается с этой версией,
+        # никто не продлевает и не снимает
+        expired = time.time() - repository.PIN_LEASE_TIME - 60
+        os.utime(os.path.join(self.store, 'pins', first, 'block-1'), (expired, expired))
+        self.assertFalse(repository.is_pinned(self.store, first, 'block-1'))
+        repository.collect_garbage(self.store)
+        self.assertNotIn(first, self.snapshots())
+        self.assertFalse(os.path.exists(os.path.join(self.store, 'pins', first)))
+
+    def test_find_snapshot_renews_pin(self):
+        head = self.commit({'s1.sc': scenario('S1')}, 'c1')
+        self.sync()
+        repository.find_snapshot(self.store, head, 'block-1')
+        marker = os.path.join(self.store, 'pins', head, 'block-1')
+
+        recent = time.time() - repository.PIN_RENEW_INTERVAL / 2
+        os.utime(marker, (recent, recent))
+        repository.find_snapshot(self.store, head, 'block-1')
+        self.assertEqual(int(os.path.getmtime(marker)), int(recent))
+
+        stale = time.time() - repository.PIN_RENEW_INTERVAL - 60
+        os.utime(marker, (stale, stale))
+        repository.find_snapshot(self.store, head, 'block-1')
+        self.assertGreater(os.path.getmtime(marker), time.time() - 60)
+
+
+class ExportTest(MirrorTestCase):
+
+    def test_reexport_collected_commit(self):
+        first = self.commit({'s1.sc': scenario('S1')}, 'c1')
+        self.sync()
+        second = self.commit({'s1.sc': scenario('S1', u'<p>%s changed</p>'), 's2.sc': scenario('S2')}, 'c2')
+        self.sync()
+        self.commit({'s3.sc': scenario('S3')}, 'c3')
+        self.sync()
+        self.assertNotIn(first, self.snapshots())
+
+        # Коммит first отсутствует и в хранилище, и в неполном локальном клоне
+        snapshot = repository.ensure_snapshot(self.store, first, 'block-1', repo_url=self.repo_url)
+        self.assertEqual(snapshot, repository.snapshot_path(self.store, first))
+        self.assertEqual(read_head_sha(snapshot), first)
+        self.assertEqual(sorted(get_index(snapshot + '/').names()), ['s1'])
+        with open(os.path.join(snapshot, 's1.sc')) as scenario_file:
+            self.assertEqual(scenario_file.read(), scenario('S1'))
+        self.assertTrue(repository.is_pinned(self.store, first, 'block-1'))
+
+        # Закрепленная версия переживает сборку мусора и следующие синхронизации
+        self.commit({'s4.sc': scenario('S4')}, 'c4')
+        self.sync()
+        self.assertIn(first, self.snapshots())
+        self.assertNotIn(second, self.snapshots())
+        self.assertEqual(repository.ensure_snapshot(self.store, first, 'block-1', repo_url=self.repo_url), snapshot)
+
+    def test_find_snapshot_queues_export(self):
+        first = self.commit({'s1.sc': scenario('S1')}, 'c1')
+        self.sync()
+        self.commit({'s2.sc': scenario('S2')}, 'c2')
+        self.sync()
+        self.commit({'s3.sc': scenario('S3')}, 'c3')
+        self.sync()
+        self.assertNotIn(first, self.snapshots())
+
+        # Отсутствующая версия не выгружается в вызывающем потоке
+        self.assertIsNone(repository.find_snapshot(self.store, first, 'block-1'))
+        job_id = repository.enqueue_export(self.store, first, 'block-1')
+        for _ in range(200):
+            job = repository.get_sync_job(job_id)
+            if job is None or job['status'] not in ('queued', 'running'):
+                break
+            time.sleep(0.05)
+        self.assertEqual(repository.get_sync_job(job_id)['status'], 'success')
+
+        snapshot = repository.find_snapshot(self.store, first, 'block-1')
+        self.assertEqual(snapshot, repository.snapshot_path(self.store, first))
+        self.assertEqual(sorted(get_index(snapshot + '/').names()), ['s1'])
+        self.assertTrue(repository.is_pinned(self.store, first, 'block-1'))
+
+    def test_find_snapshot_pins_existing_version(self):
+        head = self.commit({'s1.sc': scenario('S1')}, 'c1')
+        self.sync()
+        self.assertEqual(repository.find_snapshot(self.store, head, 'block-1'), repository.snapshot_path(self.store, head))
+        self.assertTrue(repository.is_pinned(self.store, head, 'block-1'))
+
+    def test_export_without_local_clone(self):
+        head = self.commit({'s1.sc': scenario('S1')}, 'c1')
+        snapshot = repository.ensure_snapshot(self.store, head, 'block-1', repo_url=self.repo_url)
+        self.assertEqual(sorted(get_registry(snapshot + '/').scenarios()), ['s1'])
+
+
+class SeedTest(MirrorTestCase):
+
+    def legacy_checkout(self):
+        legacy_root = os.path.join(self.tmp, 'package', 'public', 'scenarios')
+        subprocess.check_call(['git', 'clone', '-q', '-b', BRANCH, self.origin, legacy_root])
+        return legacy_root
+
+    def test_seed_from_legacy_checkout(self):
+        head = self.commit({'s1.sc': scenario('S1')}, 'c1')
+        legacy_root = self.legacy_checkout()
+
+        self.assertEqual(repository.seed_store(self.store, legacy_root), head)
+        self.assertEqual(read_head_sha(self.current()), head)
+        self.assertEqual(sorted(get_index(self.current()).names()), ['s1'])
+        self.assertFalse(os.path.exists(os.path.join(self.current(), '.git')))
+
+        # Следующая синхронизация клонирует репозиторий и заменяет версию
+        second = self.commit({'s2.sc': scenario('S2')}, 'c2')
+        self.assertEqual(self.sync(), second)
+        self.assertEqual(sorted(get_registry(self.current()).scenarios()), ['s1', 's2'])
+
+    def test_seed_keeps_existing_version(self):
+        first = self.commit({'s1.sc': scenario('S1')}, 'c1')
+        legacy_root = self.legacy_checkout()
+        second = self.commit({'s2.sc': scenario('S2')}, 'c2')
+        self.sync()
+
+        self.assertEqual(repository.seed_store(self.store, legacy_root), second)
+        self.assertEqual(read_head_sha(self.current()), second)
+        self.assertNotIn(first, self.snapshots())
+
+    def test_seed_without_legacy_checkout(self):
+        self.assertIsNone(repository.seed_store(self.store, os.path.join(self.tmp, 'missing')))
+        self.assertFalse(os.path.lexists(repository.current_path(self.store)))
+
+
+if __name__ == '__main__':
+    unittest.main()